@@ -0,0 +1,98 @@
+"""
+Latency of predictions made by the fitted transformer and model versus the compiled forest
+(python3 main.py --mode export). Run from the directory with .states after training
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sklearn.ensemble import RandomForestClassifier
+
+from src.checkpoint_store import CheckpointStore
+from src.compiled_forest import CompiledForest
+from src.data_transformer import DataTransformer
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--data', help='Path to CSV file with records', required=True)
+    parser.add_argument('--state', help='Path to directory with ModelPipeline state', default=os.path.join('.states', 'mp'))
+    parser.add_argument('--batch_sizes', help='Batch sizes', type=int, nargs='*', default=[1, 10, 100, 1000, 10000])
+    parser.add_argument('-r', '--repeat', help='Number of measurements per batch size', type=int, default=20)
+    parser.add_argument('--drop', help='Columns which are not features (e.g. target)', nargs='*', default=['WITH_PAID'])
+    return parser.parse_args()
+
+
+def measure(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def check_round_trip():
+    """
+    Check that a saved and loaded predictor makes the same predictions for categories which are not strings
+    (numbers, booleans) and for missing categories
+    """
+    rng = np.random.default_rng(0)
+    n = 400
+    x = pd.DataFrame({'time': ['01-01-2020'] * n, 'number': rng.normal(size=n),
+                      'ints': pd.Series(rng.integers(0, 3, n), dtype=object),
+                      'flags': pd.Series(rng.integers(0, 2, n).astype(bool), dtype=object),
+                      'strings': pd.Series(rng.choice(['a', 'b', None], n), dtype=object)})
+    y = pd.DataFrame({'target': (x['number'] + x['ints'].astype(int) > 1).astype(int)})
+    for na_method in ['median-mode', 'drop']:
+        transformer = DataTransformer('time', na_method=na_method)
+        x_train, y_train = transformer.prepare_train(x, y)
+        model = RandomForestClassifier(8, random_state=0).fit(x_train, y_train.values.ravel())
+        forest = CompiledForest(transformer, model)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'forest.npz')
+            forest.save(path)
+            loaded = CompiledForest.load(path)
+        for batch in [x, x.iloc[:10]]:  # Large and small batches look categories up differently
+            assert forest.predict(batch).equals(loaded.predict(batch))
+
+
+def main():
+    args = get_args()
+    check_round_trip()
+    store = CheckpointStore(args.state)
+    transformer = store.load_meta()['transformer']
+    model = store.load_model()
+    forest = CompiledForest(transformer, model)
+    data = pd.read_csv(args.data).drop(columns=args.drop, errors='ignore')
+    rng = np.random.default_rng(0)
+
+    def baseline(x: pd.DataFrame) -> pd.Series:
+        x, _ = transformer.prepare_pred(x)
+        return pd.Series(model.predict(x) if not x.empty else [], index=x.index)
+
+    # Columns are selected by name: their order and extra columns do not change predictions
+    x = data.iloc[rng.integers(0, data.shape[0], 1000)].reset_index(drop=True)
+    expected = baseline(x).to_numpy()
+    shuffled = x[x.columns[::-1]].assign(extra=0)
+    assert np.array_equal(forest.predict(shuffled)['predicted'].to_numpy(), expected)
+
+    print(f'{"batch":>8} {"baseline, ms":>14} {"compiled, ms":>14} {"speedup":>8}')
+    for batch_size in args.batch_sizes:
+        x = data.iloc[rng.integers(0, data.shape[0], batch_size)].reset_index(drop=True)
+        expected = baseline(x)
+        assert np.array_equal(forest.predict(x)['predicted'].to_numpy(), expected.to_numpy())
+        base_time = measure(lambda: baseline(x), args.repeat)
+        compiled_time = measure(lambda: forest.predict(x), args.repeat)
+        print(f'{batch_size:>8} {1000 * base_time:>14.3f} {1000 * compiled_time:>14.3f} '
+              f'{base_time / compiled_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
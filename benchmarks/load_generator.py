@@ -0,0 +1,78 @@
+"""
+Load generator for the prediction server (python3 main.py --mode serve).
+Sends records of a CSV file over several keep-alive connections and reports throughput and latency percentiles
+"""
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+import pandas as pd
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--data', help='Path to CSV file with records', required=True)
+    parser.add_argument('--host', help='Host of prediction server', default='127.0.0.1')
+    parser.add_argument('--port', help='Port of prediction server', type=int, default=8000)
+    parser.add_argument('-c', '--concurrency', help='Number of concurrent connections', type=int, default=16)
+    parser.add_argument('-n', '--n_requests', help='Total number of requests', type=int, default=2000)
+    parser.add_argument('-b', '--batch_size', help='Number of records per request', type=int, default=1)
+    parser.add_argument('--drop', help='Columns which are not sent (e.g. target)', nargs='*', default=['WITH_PAID'])
+    return parser.parse_args()
+
+
+async def request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, path: str,
+                  body: bytes = b'') -> tuple[int, bytes]:
+    writer.write(f'{method} {path} HTTP/1.1\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def worker(args: argparse.Namespace, bodies: list[bytes], requests: range, latencies: list[float],
+                 statuses: dict[int, int]):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    for k in requests:
+        start = time.perf_counter()
+        status, _ = await request(reader, writer, 'POST', '/predict', bodies[k % len(bodies)])
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+    writer.close()
+
+
+async def run(args: argparse.Namespace):
+    data = pd.read_csv(args.data).drop(columns=args.drop, errors='ignore')
+    # Missing values are sent as null
+    records = json.loads(data.to_json(orient='records'))
+    bodies = [json.dumps(records[i:i + args.batch_size]).encode() for i in range(0, len(records), args.batch_size)]
+
+    latencies, statuses = [], {}
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(args, bodies, range(w, args.n_requests, args.concurrency), latencies, statuses)
+                           for w in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    print(f'Requests: {args.n_requests}, statuses: {statuses}')
+    print(f'Throughput: {args.n_requests / elapsed:.1f} requests/s, {args.n_requests * args.batch_size / elapsed:.1f} '
+          f'records/s')
+    print(f'Client latency: p50 {np.percentile(latencies, 50):.2f} ms, p99 {np.percentile(latencies, 99):.2f} ms')
+
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, body = await request(reader, writer, 'GET', '/metrics')
+    writer.close()
+    print(f'Server metrics: {json.loads(body)}')
+
+
+if __name__ == '__main__':
+    asyncio.run(run(get_args()))
@@ -0,0 +1,87 @@
+"""
+Startup time of main.py modes. Every mode is run on the first rows of a dataset in a temporary directory;
+wall time and time spent on imports (python -X importtime) are reported as JSON
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+
+PATH_TO_MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--data', help='Path to CSV file with dataset', required=True)
+    parser.add_argument('--n_rows', help='Number of rows of the dataset used', type=int, default=500)
+    parser.add_argument('--target', help='Target column (removed from inference input)', default='WITH_PAID')
+    parser.add_argument('-o', '--out', help='Path to output JSON file')
+    parser.add_argument('--limit', help='Maximum wall time of a mode in seconds, e.g. summary=1. '
+                                        'Exit code is 1 if a limit is exceeded', nargs='*', default=[])
+    return parser.parse_args()
+
+
+def run_mode(argv: list[str], cwd: str) -> dict[str, float]:
+    """
+    Run main.py and measure its startup
+
+    :param argv: arguments of main.py
+    :param cwd: working directory
+    :return: dict with wall time and import time in seconds
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', PATH_TO_MAIN] + argv, cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'main.py {" ".join(argv)} failed:\n{result.stderr[-2000:]}')
+    # Top-level imports have no indentation; their cumulative times (in microseconds) include nested imports
+    imports = 0
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and not line.startswith('import time: self'):
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if not name.startswith('  '):
+                imports += int(cumulative)
+    return {'wall': wall, 'imports': imports / 1e6}
+
+
+def main():
+    args = get_args()
+    results = {}
+    with tempfile.TemporaryDirectory() as cwd:
+        data = pd.read_csv(args.data, nrows=args.n_rows)
+        data.to_csv(os.path.join(cwd, 'data.csv'), index=False)
+        data.drop(columns=[args.target]).to_csv(os.path.join(cwd, 'x.csv'), index=False)
+        modes = {
+            'help': ['--help'],
+            'train': ['--mode', 'train', '--data', 'data.csv', '--n_iter', '1'],
+            'update': ['--mode', 'update', '--data', 'data.csv'],
+            # Inference loads the predictor compiled by export
+            'export': ['--mode', 'export'],
+            'inference': ['--mode', 'inference', '--data', 'x.csv', '--out', 'out.csv'],
+            'summary': ['--mode', 'summary'],
+        }
+        for mode, argv in modes.items():
+            results[mode] = run_mode(argv, cwd)
+            print(f'{mode:>10}: {results[mode]["wall"]:.3f} s, imports {results[mode]["imports"]:.3f} s')
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    exceeded = []
+    for limit in args.limit:
+        mode, seconds = limit.split('=')
+        if results[mode]['wall'] > float(seconds):
+            exceeded.append(f'{mode}: {results[mode]["wall"]:.3f} s > {seconds} s')
+    if exceeded:
+        print('Startup time limits exceeded: ' + ', '.join(exceeded))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+"""
+Benchmark suite: throughput, latency and peak memory of pipeline stages and CLI modes on synthetic data
+(see synthetic_data.py). Results are saved as JSON; pass --baseline to compare them with results of another commit.
+
+Stages:
+    read           DataProvider reading the file by months in streaming mode
+    analyze        DataAnalyzer.analyze on batches
+    prepare_train  DataTransformer.prepare_train on all rows
+    prepare_pred   DataTransformer.prepare_pred on all rows (1% of rows have unknown categories)
+    collector_add  DataCollector.add on batches
+    pipeline_fit   ModelPipeline.fit (parameters search) on at most --fit_rows rows
+Modes are run as separate processes: train (one batch), update, inference, export and summary
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+import warnings
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic_data import write_csv
+from src.data_analyzer import DataAnalyzer
+from src.data_collector import DataCollector
+from src.data_provider import DataProvider
+from src.data_transformer import DataTransformer
+from src.schema import Schema
+from src.utils import data_to_xy
+
+TARGET = 'WITH_PAID'
+TIMESTAMPS = 'INSR_BEGIN'
+BATCH_SIZE = 100000  # Number of rows per call of batch stages
+
+warnings.filterwarnings('ignore')
+
+
+def bench_read(data: pd.DataFrame, path: str, work_dir: str) -> list[float]:
+    provider = DataProvider(path, TIMESTAMPS, os.path.join(work_dir, 'dp.pkl'), stream=True, chunk_size=BATCH_SIZE)
+    latencies = []
+    while True:
+        start = time.perf_counter()
+        batch = provider.get_window_data('M')
+        latencies.append(time.perf_counter() - start)
+        if batch.empty:
+            return latencies
+
+
+def bench_analyze(data: pd.DataFrame, path: str, work_dir: str) -> list[float]:
+    analyzer = DataAnalyzer()
+    latencies = []
+    for i in range(0, data.shape[0], BATCH_SIZE):
+        batch = data.iloc[i:i + BATCH_SIZE]
+        start = time.perf_counter()
+        analyzer.analyze(batch)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_prepare_train(data: pd.DataFrame, path: str, work_dir: str) -> list[float]:
+    x, y = data_to_xy(data, TARGET)
+    start = time.perf_counter()
+    DataTransformer(TIMESTAMPS, na_method='median-mode', ctg_method='ohe').prepare_train(x, y)
+    return [time.perf_counter() - start]
+
+
+def bench_prepare_pred(data: pd.DataFrame, path: str, work_dir: str) -> list[float]:
+    x, y = data_to_xy(data, TARGET)
+    transformer = DataTransformer(TIMESTAMPS, na_method='median-mode', ctg_method='ohe')
+    transformer.prepare_train(x, y)
+    x = x.copy()
+    if isinstance(x['MAKE'].dtype, pd.CategoricalDtype):
+        x['MAKE'] = x['MAKE'].cat.add_categories(['UNKNOWN'])
+    x.loc[x.index[::100], 'MAKE'] = 'UNKNOWN'
+    start = time.perf_counter()
+    transformer.prepare_pred(x, y)
+    return [time.perf_counter() - start]
+
+
+def bench_collector_add(data: pd.DataFrame, path: str, work_dir: str) -> list[float]:
+    x, y = data_to_xy(data, TARGET)
+    collector = DataCollector()
+    latencies = []
+    for i in range(0, data.shape[0], BATCH_SIZE // 10):
+        batch_x, batch_y = x.iloc[i:i + BATCH_SIZE // 10], y.iloc[i:i + BATCH_SIZE // 10]
+        start = time.perf_counter()
+        collector.add(batch_x, batch_y)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_pipeline_fit(data: pd.DataFrame, path: str, work_dir: str, fit_rows: int) -> list[float]:
+    from sklearn.ensemble import RandomForestClassifier
+    from src.model import ModelPipeline
+
+    x, y = data_to_xy(data.iloc[:fit_rows], TARGET)
+    pipeline = ModelPipeline(DataTransformer(TIMESTAMPS, na_method='median-mode', ctg_method='ohe'),
+                             RandomForestClassifier(), {'n_estimators': [4], 'max_depth': [8, 16]},
+                             os.path.join(work_dir, 'mp'))
+    start = time.perf_counter()
+    pipeline.fit(x, y)
+    return [time.perf_counter() - start]
+
+
+STAGES = ['read', 'analyze', 'prepare_train', 'prepare_pred', 'collector_add', 'pipeline_fit']
+MODES = ['train', 'update', 'inference', 'export', 'summary']
+
+
+def measure_stage(stage: typing.Callable, n_rows: int, memory: bool) -> dict[str, typing.Any]:
+    """
+    Measure stage: time is measured without memory tracing, then peak memory is measured in a separate run
+
+    :param stage: function which runs the stage and returns durations of its calls
+    :param n_rows: number of processed rows
+    :param memory: whether to measure peak memory
+    :return: results
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        latencies = np.array(stage(work_dir))
+    seconds = float(latencies.sum())
+    result = {'seconds': seconds, 'rows_per_second': n_rows / seconds if seconds > 0 else None,
+              'calls': int(latencies.shape[0]), 'latency_ms_p50': 1000 * float(np.percentile(latencies, 50)),
+              'latency_ms_max': 1000 * float(latencies.max()), 'peak_mb': None}
+    if memory:
+        with tempfile.TemporaryDirectory() as work_dir:
+            tracemalloc.start()
+            stage(work_dir)
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+    return result
+
+
+def run_mode(argv: list[str], cwd: str) -> dict[str, typing.Any]:
+    """
+    Run main.py and measure its wall time and peak resident memory
+
+    :param argv: arguments of main.py
+    :param cwd: working directory
+    :return: results
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')] + argv, cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Peak memory of a child reported by getrusage includes memory of this process at fork,
+    # so the high water mark of the child is polled instead (Linux only, None elsewhere)
+    peak = None
+    path_to_status = f'/proc/{process.pid}/status'
+    while process.poll() is None:
+        try:
+            with open(path_to_status) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peak = max(peak or 0, int(line.split()[1]) / 2 ** 10)
+        except OSError:
+            pass
+        time.sleep(0.01)
+    seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f'main.py {" ".join(argv)} failed')
+    return {'seconds': seconds, 'peak_mb': peak}
+
+
+def bench_modes(path: str, n_rows: int) -> dict[str, dict[str, typing.Any]]:
+    results = {}
+    with tempfile.TemporaryDirectory() as cwd:
+        data = pd.read_csv(path)
+        data.drop(columns=[TARGET]).to_csv(os.path.join(cwd, 'x.csv'), index=False)
+        shutil.copy(path, os.path.join(cwd, 'data.csv'))
+        modes = {
+            'train': ['--mode', 'train', '--data', 'data.csv', '--n_iter', '1'],
+            'update': ['--mode', 'update', '--data', 'data.csv'],
+            'inference': ['--mode', 'inference', '--data', 'x.csv', '--out', 'out.csv'],
+            'export': ['--mode', 'export'],
+            'summary': ['--mode', 'summary'],
+        }
+        for mode, argv in modes.items():
+            results[mode] = run_mode(argv, cwd)
+            if mode == 'inference':
+                results[mode]['rows_per_second'] = n_rows / results[mode]['seconds']
+    return results
+
+
+def git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict[str, typing.Any], baseline: dict[str, typing.Any]):
+    """
+    Print ratios of times of stages and modes to times of the baseline (below 1 is faster)
+    """
+    print(f'Comparison with {baseline.get("commit")}:')
+    for size, sections in results['results'].items():
+        for section, entries in sections.items():
+            for name, entry in entries.items():
+                old = baseline['results'].get(size, {}).get(section, {}).get(name)
+                if old is None or not old['seconds']:
+                    continue
+                print(f'{size:>10} {name:>15}: {entry["seconds"] / old["seconds"]:.2f}x time')
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', help='Numbers of rows (up to 10M)', type=int, nargs='*',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--stages', help='Stages', nargs='*', choices=STAGES, default=STAGES)
+    parser.add_argument('--modes', help='CLI modes (none to skip)', nargs='*', choices=MODES, default=MODES)
+    parser.add_argument('--fit_rows', help='Maximum number of rows for pipeline_fit', type=int, default=100000)
+    parser.add_argument('--make_cardinality', help='Number of distinct values of MAKE', type=int, default=10)
+    parser.add_argument('--seed', help='Seed of synthetic data', type=int, default=0)
+    parser.add_argument('--no_memory', help='Do not measure peak memory of stages (halves run time)',
+                        action='store_true')
+    parser.add_argument('--data_dir', help='Directory with generated datasets (reused between runs)',
+                        default=os.path.join('.benchmarks', 'data'))
+    parser.add_argument('-o', '--out', help='Path to output JSON file', default='benchmark.json')
+    parser.add_argument('--baseline', help='Path to JSON file with results to compare with')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+               'platform': platform.platform(), 'config': vars(args), 'results': {}}
+
+    for n_rows in args.sizes:
+        path = os.path.join(args.data_dir, f'synthetic_{n_rows}_{args.seed}_{args.make_cardinality}.csv')
+        if not os.path.exists(path):
+            write_csv(path, n_rows, seed=args.seed, make_cardinality=args.make_cardinality)
+        # Stages receive data with compact types, as DataProvider hands it out
+        data = Schema().apply(pd.read_csv(path))
+        stages = {
+            'read': bench_read, 'analyze': bench_analyze, 'prepare_train': bench_prepare_train,
+            'prepare_pred': bench_prepare_pred, 'collector_add': bench_collector_add,
+            'pipeline_fit': lambda d, p, w: bench_pipeline_fit(d, p, w, args.fit_rows),
+        }
+        size_results = {'stages': {}, 'modes': {}}
+        for name in args.stages:
+            rows = min(n_rows, args.fit_rows) if name == 'pipeline_fit' else n_rows
+            size_results['stages'][name] = measure_stage(lambda work_dir: stages[name](data, path, work_dir), rows,
+                                                         not args.no_memory)
+            entry = size_results['stages'][name]
+            print(f'{n_rows:>10} {name:>15}: {entry["seconds"]:.3f} s, {entry["rows_per_second"] or 0:.0f} rows/s, '
+                  f'p50 {entry["latency_ms_p50"]:.1f} ms, peak {entry["peak_mb"] or 0:.1f} MB')
+        if args.modes:
+            modes = bench_modes(path, n_rows)
+            size_results['modes'] = {mode: modes[mode] for mode in args.modes}
+            for mode, entry in size_results['modes'].items():
+                print(f'{n_rows:>10} {mode:>15}: {entry["seconds"]:.3f} s, peak {entry["peak_mb"] or 0:.1f} MB')
+        results['results'][str(n_rows)] = size_results
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Seeded generator of synthetic data with the schema of the motor insurance dataset:
+INSR_BEGIN time stamps (sorted, like in the real file), object categorical columns with configurable cardinality,
+numeric columns with missing values and WITH_PAID target which depends on features
+"""
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+TYPES_OF_VEHICLE = ['Pick-up', 'Truck', 'Automobile', 'Bus', 'Station Wagones', 'Motor-cycle', 'Tanker',
+                    'Tractor', 'Special construction', 'Trailers and semitrailers']
+MAKES = ['TOYOTA', 'ISUZU', 'NISSAN', 'MITSUBISHI', 'IVECO', 'FIAT', 'VOLVO', 'MERCEDES', 'HYUNDAI', 'BAJAJ']
+USAGES = ['Own Goods', 'Private', 'General Cartage', 'Fare Paying Passengers', 'Own service', 'Taxi',
+          'Car Hires', 'Ambulance', 'Learnes', 'Agricultural Own Farm']
+
+
+def categories(names: list[str], cardinality: int, prefix: str) -> np.ndarray:
+    """
+    Take real category names and add synthetic ones up to the required cardinality
+    """
+    extra = [f'{prefix}_{i:05}' for i in range(max(cardinality - len(names), 0))]
+    return np.array((names + extra)[:cardinality], dtype=object)
+
+
+def generate(n_rows: int, seed=0, start=0, total: int = None, make_cardinality=10, na_rate=0.05,
+             days=1460) -> pd.DataFrame:
+    """
+    Generate rows [start, start + n_rows) of a synthetic dataset with total rows.
+    Random numbers are seeded by seed and start, so the same parts of the same dataset are always the same
+
+    :param n_rows: number of rows
+    :param seed: seed
+    :param start: position of the first row
+    :param total: number of rows of the whole dataset (n_rows by default)
+    :param make_cardinality: number of distinct values of MAKE (values follow a Zipf-like distribution)
+    :param na_rate: share of missing values in PREMIUM, PROD_YEAR and MAKE
+    :param days: number of days covered by time stamps
+    :return: data
+    """
+    total = n_rows if total is None else total
+    rng = np.random.default_rng([seed, start])
+
+    # Time stamps grow with row position, several rows share a day
+    day = (np.arange(start, start + n_rows) * days) // max(total, 1)
+    dates = pd.Timestamp('2011-07-01') + pd.to_timedelta(day, unit='D')
+    makes = categories(MAKES, make_cardinality, 'MAKE')
+    weights = 1 / np.arange(1, makes.shape[0] + 1)
+
+    data = pd.DataFrame({
+        'SEX': rng.choice([0, 1, 2], n_rows, p=[0.3, 0.5, 0.2]),
+        'INSR_BEGIN': dates.strftime('%d-%b-%y').str.upper(),
+        'INSR_TYPE': rng.choice([1201, 1202, 1204], n_rows, p=[0.2, 0.7, 0.1]),
+        'INSURED_VALUE': rng.gamma(2, 1e5, n_rows).round(),
+        'PREMIUM': rng.gamma(2, 2e3, n_rows).round(2),
+        'PROD_YEAR': rng.integers(1970, 2014, n_rows).astype(np.float64),
+        'SEATS_NUM': rng.integers(0, 60, n_rows),
+        'TYPE_VEHICLE': rng.choice(np.array(TYPES_OF_VEHICLE, dtype=object), n_rows),
+        'MAKE': rng.choice(makes, n_rows, p=weights / weights.sum()),
+        'USAGE': rng.choice(np.array(USAGES, dtype=object), n_rows),
+    })
+    for col in ['PREMIUM', 'PROD_YEAR', 'MAKE']:
+        data.loc[rng.random(n_rows) < na_rate, col] = None
+
+    # Claims are more likely for trucks, old vehicles and large premiums
+    logit = (-1.5 + 1.0 * (data['TYPE_VEHICLE'] == 'Truck') + 0.02 * (2014 - data['PROD_YEAR'].fillna(2000))
+             + 0.3 * np.log1p(data['PREMIUM'].fillna(0)) / 10)
+    data['WITH_PAID'] = (rng.random(n_rows) < 1 / (1 + np.exp(-logit))).astype(int)
+    data.index = pd.RangeIndex(start, start + n_rows)
+    return data
+
+
+def write_csv(path: str, n_rows: int, seed=0, chunk_size=1000000, **kwargs):
+    """
+    Generate a synthetic dataset chunk by chunk and write it to a CSV file.
+    The file depends only on seed, chunk_size and parameters of data
+
+    :param path: path to CSV file
+    :param n_rows: number of rows
+    :param seed: seed
+    :param chunk_size: number of rows generated at once
+    :param kwargs: parameters of generate
+    """
+    tmp_path = f'{path}.tmp'
+    for start in range(0, n_rows, chunk_size):
+        chunk = generate(min(chunk_size, n_rows - start), seed=seed, start=start, total=n_rows, **kwargs)
+        chunk.to_csv(tmp_path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+    os.replace(tmp_path, path)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n_rows', help='Number of rows', type=int, default=10000)
+    parser.add_argument('-o', '--out', help='Path to output CSV file', required=True)
+    parser.add_argument('--seed', help='Seed', type=int, default=0)
+    parser.add_argument('--make_cardinality', help='Number of distinct values of MAKE', type=int, default=10)
+    parser.add_argument('--na_rate', help='Share of missing values', type=float, default=0.05)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    write_csv(args.out, args.n_rows, seed=args.seed, make_cardinality=args.make_cardinality, na_rate=args.na_rate)
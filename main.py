@@ -1,44 +1,122 @@
+from __future__ import annotations
+
 import typing
 import os
-import time
 import argparse
 import logging
-import yaml
-import numpy as np
-import pandas as pd
+import functools
+import importlib
+import warnings
 from datetime import datetime
-from memory_profiler import profile
-from sklearn.ensemble import RandomForestClassifier
-from scipy.spatial.distance import cosine
 
-from src.utils import data_to_xy, xy_to_data
-from src.data_provider import DataProvider
-from src.data_analyzer import DataAnalyzer
-from src.data_transformer import DataTransformer
-from src.model import ModelPipeline
+# Modes import only the modules they use, so that e.g. summary or --help do not load sklearn or matplotlib
+if typing.TYPE_CHECKING:
+    import pandas as pd
+    from src.checkpoint_store import CheckpointStore
+    from src.column_cache import ColumnCache
+    from src.data_analyzer import DataAnalyzer
+    from src.data_provider import DataProvider
+    from src.drift_detector import DriftDetector
+    from src.model import ModelPipeline
+    from src.replay import Prefetcher
+    from src.schema import Schema
 
-import warnings
 warnings.filterwarnings('ignore')
 
 TARGET = 'WITH_PAID'  # Target column in data
 TIMESTAMPS = 'INSR_BEGIN'  # Column with timestamps
 PATH_TO_DATA_PROVIDER_SAVES = os.path.join('.states', 'dp.pkl')  # Path to file with DataProvider saved state
-PATH_TO_MODEL_PIPELINE_SAVES = os.path.join('.states', 'mp.pkl')  # Path to file with ModelPipeline saved state
+PATH_TO_SCHEMA_SAVES = os.path.join('.states', 'schema.pkl')  # Path to file with column types of received data
+PATH_TO_MODEL_PIPELINE_SAVES = os.path.join('.states', 'mp')  # Path to directory with ModelPipeline saved state
+PATH_TO_DATA_ANALYZER_SAVES = os.path.join('.states', 'da.pkl')  # Path to file with DataAnalyzer saved state
+PATH_TO_DRIFT_DETECTOR_SAVES = os.path.join('.states', 'dd.pkl')  # Path to file with DriftDetector saved state
+PATH_TO_SCORE_CACHE = os.path.join('.states', 'cv_cache')  # Path to directory with cached cross-validation results
+PATH_TO_COLUMN_CACHE = os.path.join('.states', 'column_cache')  # Path to directory with columnar copies of datasets
+PATH_TO_COMPILED_MODEL = os.path.join('.states', 'forest.npz')  # Default path to file with exported model
+PATH_TO_MODEL_IMAGE = 'best_model.png'  # Path to image with trees of the selected model
 PAUSE = 3  # Pause (in seconds) between data arrivals
+HISTORY_SIZE = None  # Maximum number of stored samples (None for no limit)
+HISTORY_POLICY = 'window'  # Which samples to keep when HISTORY_SIZE is exceeded: 'window' or 'reservoir'
+
+
+# Modules used to initialize ModelPipeline (see init_pipeline)
+PIPELINE_MODULES = ['sklearn.ensemble', 'src.data_collector', 'src.data_transformer', 'src.model',
+                    'src.model_visualizer', 'src.score_cache', 'src.sharded_training']
+
 
-if not os.path.exists('.states'):
-    os.mkdir('.states')
+def profile(*modules: str) -> typing.Callable:
+    """
+    Report memory usage of a mode line by line with memory_profiler if the mode is run with --profile.
+    Modules used by the mode are imported before profiling starts, so that their import is not traced
+
+    :param modules: modules used by the mode
+    """
+    def decorator(func: typing.Callable) -> typing.Callable:
+        @functools.wraps(func)
+        def wrapper(args: argparse.Namespace):
+            if not args.profile:
+                return func(args)
+            from memory_profiler import profile as memory_profile
+            for module in modules:
+                importlib.import_module(module)
+            return memory_profile(func)(args)
+        return wrapper
+    return decorator
 
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='Path to YAML config')
     parser.add_argument('-d', '--data', help='Path to CSV file with dataset')
-    parser.add_argument('-o', '--out', help='Output path for inference')
+    parser.add_argument('-o', '--out', help='Output path for inference, export and backtest results')
     #parser.add_argument('-l', '--logs', help='Path to folder with logs', default='.logs')
-    parser.add_argument('-m', '--mode', choices=['train', 'update', 'eval', 'inference', 'summary'], help='Action type')
-    parser.add_argument('-n', '--n_iter', help='Number of training iterations. Set 0 to train on all data',
-                        type=int, default=0)
+    parser.add_argument('-m', '--mode', choices=['train', 'update', 'eval', 'backtest', 'inference', 'serve', 'export',
+                                                 'summary'], help='Action type')
+    parser.add_argument('-n', '--n_iter', help='Number of training iterations (test windows in backtest). '
+                                               'Set 0 to train on all data', type=int, default=0)
+    parser.add_argument('-s', '--stream', help='Read dataset in chunks instead of loading it entirely',
+                        action='store_true')
+    parser.add_argument('--cache', help='Convert dataset once to columnar binary files (in .states/column_cache) '
+                                        'and read them memory-mapped instead of parsing CSV', action='store_true')
+    parser.add_argument('--chunk_size', help='Number of rows read at once in streaming mode and inference',
+                        type=int, default=10000)
+    parser.add_argument('-w', '--window', choices=['D', 'W', 'M'],
+                        help='Replay data by time windows (day, week or month) instead of fixed-size batches. '
+                             'Backtest uses months by default')
+    parser.add_argument('-i', '--incremental', help='Grow the selected model with new trees instead of rerunning '
+                                                    'parameters search on every batch', action='store_true')
+    parser.add_argument('--reselect_every', help='Number of batches between parameters searches in incremental mode',
+                        type=int, default=10)
+    parser.add_argument('--search', choices=['grid', 'random', 'halving'], default='grid',
+                        help='Hyperparameters search method')
+    parser.add_argument('-j', '--n_jobs', help='Number of worker processes for hyperparameters search, inference and '
+                                               'backtest', type=int, default=1)
+    parser.add_argument('--n_candidates', help='Number of parameter combinations evaluated by random search',
+                        type=int)
+    parser.add_argument('--host', help='Host of prediction server', default='127.0.0.1')
+    parser.add_argument('--port', help='Port of prediction server', type=int, default=8000)
+    parser.add_argument('--max_batch_size', help='Number of records after which prediction server stops grouping '
+                                                 'requests into a micro-batch', type=int, default=256)
+    parser.add_argument('--history', help='Number of windows a model is trained on in backtest (all previous windows '
+                                          'by default)', type=int)
+    parser.add_argument('--clock', choices=['realtime', 'scaled', 'fast'], default='realtime',
+                        help='Replay clock of train and eval: pause between batches, pause divided by --speed '
+                             'or no pause')
+    parser.add_argument('--speed', help='Acceleration of the scaled clock', type=float, default=10.0)
+    parser.add_argument('--prefetch', help='Number of batches read and analyzed in background ahead of training '
+                                           '(0 to disable)', type=int, default=2)
+    parser.add_argument('--features', choices=['frame', 'dense', 'sparse'], default='frame',
+                        help='Format of features the model is trained on: data frame, float32 array or float32 CSR '
+                             'matrix (matrices take less memory)')
+    parser.add_argument('--shard_size', help='Train out of core: sub-forests are trained on shards of stored data '
+                                             'of about this number of rows (in -j processes) and merged; '
+                                             'only the latest shard is kept in memory', type=int)
+    parser.add_argument('-p', '--plot', help='Draw trees of the selected model in background', action='store_true')
+    parser.add_argument('--metrics', help='Path to file to save timers and counters of pipeline stages to')
+    parser.add_argument('--metrics_format', choices=['jsonl', 'prometheus'], default='jsonl',
+                        help='Format of metrics: JSON lines (appended) or Prometheus text (replaced)')
+    parser.add_argument('--profile', help='Report memory usage of train, update, eval and inference line by line '
+                                          '(slow)', action='store_true')
     parser.add_argument('-v', '--verbose', help='Increase output verbosity', action='store_true')
     return parser.parse_args()
 
@@ -48,6 +126,7 @@ def read_config(args: argparse.Namespace):
     if not fn:
         return
 
+    import yaml
     with open(fn, 'r') as f:
         config = yaml.safe_load(f)
     for k, v in config.items():
@@ -76,6 +155,43 @@ def init_logger(log_dir: str):
 """
 
 
+def receive_data(data_provider: DataProvider, args: argparse.Namespace) -> pd.DataFrame:
+    if args.window is not None:
+        return data_provider.get_window_data(args.window)
+    return data_provider.get_batch()
+
+
+def prefetch_batches(data_provider: DataProvider, data_analyzer: DataAnalyzer, args: argparse.Namespace,
+                     drift_detector: DriftDetector = None) -> Prefetcher:
+    """
+    Receive and analyze batches (and check data drift) in background while previous batches are processed.
+    Items are dicts with data, its statistics, drift scores and states of components to commit after processing
+    """
+    from src.replay import Prefetcher
+
+    components = [component for component in (data_provider, data_analyzer, drift_detector) if component is not None]
+
+    def produce() -> typing.Optional[dict[str, typing.Any]]:
+        data = receive_data(data_provider, args)
+        if data.empty:
+            return None
+        stat = data_analyzer.analyze(data)
+        drift_scores = None
+        if drift_detector is not None:
+            drift_scores = drift_detector.update(data, data_analyzer)
+            if drift_scores is not None and drift_scores['drift'].any():
+                drift_detector.rebase()
+        return {'data': data, 'stat': stat, 'drift_scores': drift_scores,
+                'states': [(component, component.state()) for component in components]}
+
+    return Prefetcher(produce, depth=args.prefetch)
+
+
+def commit_batch(batch: dict[str, typing.Any]):
+    for component, state in batch['states']:
+        component.commit(state)
+
+
 def init_logger():
     logging.basicConfig(filename='training.log', level=logging.INFO, format='%(asctime)s - %(message)s')
 
@@ -87,84 +203,163 @@ def log_data_quality(data_quality: dict[str, typing.Any]):
     logging.info(f'rows_with_na: {100 * rows_with_na}%')
 
 
-# Initialize data transformer
-data_transformer = DataTransformer(TIMESTAMPS, na_method='median-mode', ctg_method='ohe')
-# Initialize ML model
-model = RandomForestClassifier()
 # Initialize parameters grid
 params = {'n_estimators': [1, 2, 4],
           'max_depth': [4, 16, 64, 256],
           }
-# Initialize ModelPipeline
-pipeline = ModelPipeline(data_transformer, model, params, PATH_TO_MODEL_PIPELINE_SAVES)
 
 
-@profile
+def init_cache(args: argparse.Namespace, schema: Schema = None) -> typing.Optional[ColumnCache]:
+    """
+    Initialize columnar cache of the dataset if it is requested
+
+    :param args: arguments
+    :param schema: column types the cache is built with
+    """
+    if not args.cache:
+        return None
+    from src.column_cache import ColumnCache
+
+    return ColumnCache(args.data, PATH_TO_COLUMN_CACHE, schema)
+
+
+def init_pipeline(args: argparse.Namespace, persistent=True) -> ModelPipeline:
+    """
+    Initialize model pipeline
+
+    :param args: arguments
+    :param persistent: if False, pipeline keeps its state in memory only and does not use .states (e.g. in backtest)
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    from src.data_collector import DataCollector
+    from src.data_transformer import DataTransformer
+    from src.model import ModelPipeline
+    from src.model_visualizer import ModelVisualizer
+    from src.score_cache import ScoreCache
+
+    # Initialize data transformer
+    data_transformer = DataTransformer(TIMESTAMPS, na_method='median-mode', ctg_method='ohe')
+    # Initialize ML model
+    model = RandomForestClassifier()
+    # Initialize data storage
+    data_collector = DataCollector(max_size=HISTORY_SIZE, policy=HISTORY_POLICY)
+    if not persistent:
+        # Backtest trains on windows held in memory, so shards are not used
+        return ModelPipeline(data_transformer, model, params, data=data_collector, search=args.search,
+                             n_candidates=args.n_candidates, incremental=args.incremental,
+                             reselect_every=args.reselect_every, features=args.features)
+    if args.shard_size is not None:
+        # Only the latest shard is kept in memory, the rest is read from the checkpoint store
+        data_collector = DataCollector(max_size=args.shard_size, policy='window')
+    # Initialize cache of cross-validation results
+    score_cache = ScoreCache(PATH_TO_SCORE_CACHE)
+    # Initialize drawing of the selected model
+    visualizer = ModelVisualizer(PATH_TO_MODEL_IMAGE) if args.plot else None
+    # Initialize ModelPipeline
+    return ModelPipeline(data_transformer, model, params, PATH_TO_MODEL_PIPELINE_SAVES, data=data_collector,
+                         search=args.search, n_jobs=args.n_jobs, n_candidates=args.n_candidates, cache=score_cache,
+                         visualizer=visualizer, incremental=args.incremental, reselect_every=args.reselect_every,
+                         features=args.features, shard_size=args.shard_size)
+
+
+def init_store(args: argparse.Namespace) -> CheckpointStore:
+    """
+    Initialize storage of model pipeline state for modes which only read it (inference, serve, export).
+    State saved by an older version is converted first
+
+    :param args: arguments
+    """
+    from src.checkpoint_store import CheckpointStore
+
+    store = CheckpointStore(PATH_TO_MODEL_PIPELINE_SAVES)
+    if not store.exists():
+        # Convert state saved by an older version
+        init_pipeline(args).load()
+    return store
+
+
+@profile('src.utils', 'src.data_provider', 'src.data_analyzer', 'src.drift_detector', 'src.replay',
+         *PIPELINE_MODULES)
 def train(args: argparse.Namespace):
     assert args.data is not None
     #assert args.logs is not None
     assert args.n_iter is not None
 
+    from src.utils import data_to_xy
+    from src.data_provider import DataProvider
+    from src.schema import Schema
+    from src.data_analyzer import DataAnalyzer
+    from src.drift_detector import DriftDetector
+    from src.replay import ReplayClock
+
     # Initialize logger
     #init_logger(args.logs)
     init_logger()
 
-    # Initialize data provider
+    # Initialize data provider. States of components are saved after a batch is processed (see prefetch_batches)
     raw_data_path = args.data
-    data_provider = DataProvider(raw_data_path, TIMESTAMPS, PATH_TO_DATA_PROVIDER_SAVES)
+    schema = Schema(PATH_TO_SCHEMA_SAVES)
+    data_provider = DataProvider(raw_data_path, TIMESTAMPS, PATH_TO_DATA_PROVIDER_SAVES,
+                                 stream=args.stream, chunk_size=args.chunk_size, schema=schema, autosave=False,
+                                 cache=init_cache(args, schema))
 
     # Initialize data analyzer
-    data_analyzer = DataAnalyzer()
+    data_analyzer = DataAnalyzer(PATH_TO_DATA_ANALYZER_SAVES, autosave=False)
+
+    # Initialize data drift detector
+    drift_detector = DriftDetector(PATH_TO_DRIFT_DETECTOR_SAVES, ignore=[TIMESTAMPS], autosave=False)
+
+    # Initialize model pipeline
+    pipeline = init_pipeline(args)
+
+    # Initialize clock emulating delay between data arrivals
+    clock = ReplayClock(args.clock, pause=PAUSE, speed=args.speed)
 
     if args.verbose:
         print('Training starts')
     print(f'Current position in data: {data_provider.i}')
     time_start = datetime.now()
     i = 0
-    etalon_stat = None
-    while True:
-        # Receive data batch
-        data = data_provider.get_batch()
-        if data.empty:
-            break
-        if args.verbose:
-            print('Receive new data')
-        logging.info(f'Get {data.shape[0]} samples')
-
-        # Analyze data
-        stat = data_analyzer.analyze(data)
-        log_data_quality(stat['na'])
-        if etalon_stat is not None:
-            a = np.array(stat['num_means'])
-            b = np.array(etalon_stat['num_means'])
-            #cos = a @ b / (a ** 2).sum() ** 0.5 / (b ** 2).sum() ** 0.5
-            cos_dist = cosine(a, b)
-            if cos_dist > 0.2:
-                print('Data drift detected')
-                etalon_stat = stat
-        else:
-            etalon_stat = stat
-
-        x, y = data_to_xy(data, TARGET)
-        # Evaluate model
-        if pipeline.is_fit():
-            logging.info('Evaluate model')
+    with prefetch_batches(data_provider, data_analyzer, args, drift_detector) as batches:
+        while True:
+            # Receive analyzed data batch
+            clock.wait()
+            batch = batches.get()
+            if batch is None:
+                break
+            data = batch['data']
             if args.verbose:
-                print('Evaluate model')
-            score = pipeline.eval(x, y)
-            print(f'Score: {score}')
-            logging.info(f'Score: {score}')
-        # Train model
-        if args.verbose:
-            print('Train model')
-        pipeline.fit(x, y)
-
-        i += 1
-        if i == args.n_iter:
-            break
+                print('Receive new data')
+            logging.info(f'Get {data.shape[0]} samples')
+            log_data_quality(batch['stat']['na'])
+
+            # Check data drift
+            drift_scores = batch['drift_scores']
+            if drift_scores is not None and drift_scores['drift'].any():
+                drifted = drift_scores.index[drift_scores['drift']].tolist()
+                print(f'Data drift detected: {drifted}')
+                logging.info(f'Data drift detected: {drift_scores[drift_scores["drift"]].to_dict("index")}')
+                pipeline.request_reselection()
+
+            x, y = data_to_xy(data, TARGET)
+            # Evaluate model
+            if pipeline.is_fit():
+                logging.info('Evaluate model')
+                if args.verbose:
+                    print('Evaluate model')
+                score = pipeline.eval(x, y)
+                logging.info(f'Rows with unknown categories: {pipeline.transformer.dropped_by_col}')
+                print(f'Score: {score}')
+                logging.info(f'Score: {score}')
+            # Train model
+            if args.verbose:
+                print('Train model')
+            pipeline.fit(x, y)
+            commit_batch(batch)
 
-        # Emulate delay between data arrivals
-        time.sleep(PAUSE)
+            i += 1
+            if i == args.n_iter:
+                break
     time_end = datetime.now()
     print(f'Training time: {time_end - time_start}')
     logging.info(f'Training time: {time_end - time_start}')
@@ -172,21 +367,32 @@ def train(args: argparse.Namespace):
         print('Training ends')
 
 
-@profile
+@profile('src.utils', 'src.data_provider', 'src.data_analyzer', *PIPELINE_MODULES)
 def update(args: argparse.Namespace):
     assert args.data is not None
     #assert args.logs is not None
 
+    from src.utils import data_to_xy
+    from src.data_provider import DataProvider
+    from src.schema import Schema
+    from src.data_analyzer import DataAnalyzer
+
     # Initialize logger
     #init_logger(args.logs)
     init_logger()
 
     # Initialize data provider
     raw_data_path = args.data
-    data_provider = DataProvider(raw_data_path, TIMESTAMPS, PATH_TO_DATA_PROVIDER_SAVES)
+    schema = Schema(PATH_TO_SCHEMA_SAVES)
+    data_provider = DataProvider(raw_data_path, TIMESTAMPS, PATH_TO_DATA_PROVIDER_SAVES,
+                                 stream=args.stream, chunk_size=args.chunk_size, schema=schema,
+                                 cache=init_cache(args, schema))
 
     # Initialize data analyzer
-    data_analyzer = DataAnalyzer()
+    data_analyzer = DataAnalyzer(PATH_TO_DATA_ANALYZER_SAVES)
+
+    # Initialize model pipeline
+    pipeline = init_pipeline(args)
 
     if not pipeline.is_fit():
         print('Model is not fitted')
@@ -194,7 +400,7 @@ def update(args: argparse.Namespace):
 
     print(f'Current position in data: {data_provider.i}')
     # Receive data batch
-    data = data_provider.get_batch()
+    data = receive_data(data_provider, args)
     if not data.empty:
         if args.verbose:
             print('Receive new data')
@@ -211,102 +417,231 @@ def update(args: argparse.Namespace):
         pipeline.refit(x, y)
 
 
-@profile
+@profile('src.utils', 'src.data_provider', 'src.data_analyzer', 'src.replay', *PIPELINE_MODULES)
 def evaluate(args: argparse.Namespace):
     assert args.data is not None
     #assert args.logs is not None
     assert args.n_iter is not None
 
+    from src.utils import data_to_xy
+    from src.data_provider import DataProvider
+    from src.schema import Schema
+    from src.data_analyzer import DataAnalyzer
+    from src.replay import ReplayClock
+
     # Initialize logger
     #init_logger(args.logs)
     init_logger()
 
-    # Initialize data provider
+    # Initialize data provider. States of components are saved after a batch is processed (see prefetch_batches)
     raw_data_path = args.data
-    data_provider = DataProvider(raw_data_path, TIMESTAMPS, PATH_TO_DATA_PROVIDER_SAVES)
+    schema = Schema(PATH_TO_SCHEMA_SAVES)
+    data_provider = DataProvider(raw_data_path, TIMESTAMPS, PATH_TO_DATA_PROVIDER_SAVES,
+                                 stream=args.stream, chunk_size=args.chunk_size, schema=schema, autosave=False,
+                                 cache=init_cache(args, schema))
 
     # Initialize data analyzer
-    data_analyzer = DataAnalyzer()
+    data_analyzer = DataAnalyzer(PATH_TO_DATA_ANALYZER_SAVES, autosave=False)
+
+    # Initialize model pipeline
+    pipeline = init_pipeline(args)
+
+    # Initialize clock emulating delay between data arrivals
+    clock = ReplayClock(args.clock, pause=PAUSE, speed=args.speed)
 
     if args.verbose:
         print('Evaluation starts')
     print(f'Current position in data: {data_provider.i}')
     scores = []
     i = 0
-    while True:
-        # Receive data batch
-        data = data_provider.get_batch()
-        if data.empty:
-            break
-        if args.verbose:
-            print('Receive new data')
-        logging.info(f'Get {data.shape[0]} samples')
-
-        # Analyze data
-        stat = data_analyzer.analyze(data)
-        log_data_quality(stat['na'])
-
-        x, y = data_to_xy(data, TARGET)
-        # Evaluate model
-        if pipeline.is_fit():
-            logging.info('Evaluate model')
+    with prefetch_batches(data_provider, data_analyzer, args) as batches:
+        while True:
+            # Receive analyzed data batch
+            clock.wait()
+            batch = batches.get()
+            if batch is None:
+                break
+            data = batch['data']
             if args.verbose:
-                print('Evaluate model')
-            score = pipeline.eval(x, y)
-            scores.append(score)
-            print(f'Score: {score}')
-            logging.info(f'Score: {score}')
-
-        # Emulate delay between data arrivals
-        time.sleep(PAUSE)
-        i += 1
-        if i == args.n_iter:
-            break
+                print('Receive new data')
+            logging.info(f'Get {data.shape[0]} samples')
+            log_data_quality(batch['stat']['na'])
+
+            x, y = data_to_xy(data, TARGET)
+            # Evaluate model
+            if pipeline.is_fit():
+                logging.info('Evaluate model')
+                if args.verbose:
+                    print('Evaluate model')
+                score = pipeline.eval(x, y)
+                logging.info(f'Rows with unknown categories: {pipeline.transformer.dropped_by_col}')
+                scores.append(score)
+                print(f'Score: {score}')
+                logging.info(f'Score: {score}')
+            commit_batch(batch)
+
+            i += 1
+            if i == args.n_iter:
+                break
     print(f'Mean score: {sum(scores) / len(scores)}')
     if args.verbose:
         print('Evaluation ends')
 
 
-@profile
+@profile('src.backtest', 'src.data_provider', *PIPELINE_MODULES)
+def backtest(args: argparse.Namespace):
+    assert args.data is not None
+
+    import tempfile
+    from src.backtest import walk_forward
+    from src.data_provider import DataProvider
+    from src.schema import Schema
+
+    # Split data into windows. Position and time stamp index are saved to a temporary directory, not to .states
+    windows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        schema = Schema()
+        data_provider = DataProvider(args.data, TIMESTAMPS, os.path.join(tmp_dir, 'dp.pkl'), stream=args.stream,
+                                     chunk_size=args.chunk_size, schema=schema, autosave=False,
+                                     cache=init_cache(args, schema))
+        while True:
+            data = data_provider.get_window_data(args.window or 'M')
+            if data.empty:
+                break
+            windows.append(data)
+    # Windows read from different chunks have different dictionaries of categories
+    windows = [data_provider.schema.cast(data) for data in windows]
+
+    print(f'Windows: {len(windows)}')
+    time_start = datetime.now()
+    results = []
+    make_pipeline = functools.partial(init_pipeline, args, persistent=False)
+    for result in walk_forward(windows, make_pipeline, TARGET, TIMESTAMPS, history=args.history,
+                               n_windows=args.n_iter or None, n_workers=args.n_jobs):
+        results.append(result)
+        print(f'Window {result["window"]} ({result["start"]} - {result["end"]}): train {result["n_train"]} rows, '
+              f'test {result["n_test"]} rows, score {result["score"]:.4f}, fit {result["fit_seconds"]:.2f} s, '
+              f'eval {result["eval_seconds"]:.2f} s')
+    time_end = datetime.now()
+    if results:
+        print(f'Mean score: {sum(result["score"] for result in results) / len(results)}')
+    print(f'Backtest time: {time_end - time_start}')
+
+    if args.out is not None and results:
+        import pandas as pd
+        pd.DataFrame(results).to_csv(args.out, index=False)
+
+
+@profile('src.batch_inference', 'src.checkpoint_store', 'src.compiled_forest', 'src.data_transformer')
 def inference(args: argparse.Namespace):
     assert args.data is not None
     assert args.out is not None
 
-    # Load data
-    x = pd.read_csv(args.data)
+    from src.batch_inference import predict_file
+
+    # Initialize storage of model pipeline state
+    store = init_store(args)
 
     if args.verbose:
         print('Inference starts')
-    if pipeline.is_fit():
-        # Predict
-        x, y = pipeline.predict(x)
-        # Save predictions
-        xy = xy_to_data(x, y)
-        xy.to_csv(args.out)
+    if store.exists() and store.has_model():
+        # Predict chunk by chunk and save predictions
+        predict_file(args.data, args.out, PATH_TO_MODEL_PIPELINE_SAVES, chunk_size=args.chunk_size,
+                     n_workers=args.n_jobs, cache=init_cache(args))
     else:
         print('Model is not fitted')
     if args.verbose:
         print('Inference ends')
 
 
+def serve(args: argparse.Namespace):
+    from src.prediction_server import PredictionServer
+
+    # Initialize logger
+    init_logger()
+
+    # Initialize storage of model pipeline state
+    init_store(args)
+
+    # Serve predictions until interrupted. The model is reloaded when training commits a new checkpoint
+    server = PredictionServer(PATH_TO_MODEL_PIPELINE_SAVES, host=args.host, port=args.port,
+                              max_batch_size=args.max_batch_size)
+    if args.verbose:
+        print('Server starts')
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    if args.verbose:
+        print('Server stops')
+
+
+def export(args: argparse.Namespace):
+    from src.compiled_forest import CompiledForest
+
+    # Initialize storage of model pipeline state
+    store = init_store(args)
+    if not (store.exists() and store.has_model()):
+        print('Model is not fitted')
+        return
+
+    # Compile the selected model and the fitted encoder into flat arrays.
+    # A copy is kept beside the checkpoint: inference uses it instead of the model until the next commit
+    meta = store.load_meta()
+    forest = CompiledForest(meta['transformer'], store.load_model())
+    store.save_compiled(forest)
+    path = args.out if args.out is not None else PATH_TO_COMPILED_MODEL
+    forest.save(path)
+    print(f'Model is exported to {path}')
+
+
+def summary(args: argparse.Namespace):
+    import pandas as pd
+    from src.data_analyzer import DataAnalyzer
+
+    # Load statistics of all received data
+    data_analyzer = DataAnalyzer(PATH_TO_DATA_ANALYZER_SAVES)
+    stat = data_analyzer.summary()
+    if not stat:
+        print('No data received')
+        return
+
+    print(f'Received samples: {data_analyzer.n_rows}')
+    print(f'Rows with missing values: {100 * stat["na"]["rows_with_na"]}%')
+    print('Missing values by column:')
+    print(stat['na']['na_by_col'].to_string())
+    print('Numeric columns:')
+    print(pd.DataFrame({'mean': stat['num_means'], 'median': stat['num_medians'], 'var': stat['num_vars']}).to_string())
+    print('Categorical columns (mode):')
+    print(pd.Series(stat['ctg_modes'], index=data_analyzer.categorical_cols).to_string())
+
+
 def main():
     # Get args from console
     args = get_args()
     # Read args from config
     read_config(args)
 
-    if args.mode == 'train':
-        train(args)
-    elif args.mode == 'update':
-        update(args)
-    elif args.mode == 'eval':
-        evaluate(args)
-    elif args.mode == 'inference':
-        inference(args)
-    elif args.mode == 'summary':
-        pass
-    else:
+    if not os.path.exists('.states'):
+        os.mkdir('.states')
+
+    modes = {'train': train, 'update': update, 'eval': evaluate, 'backtest': backtest, 'inference': inference,
+             'serve': serve, 'export': export, 'summary': summary}
+    if args.mode not in modes:
         print('No mode is specified')
+        return
+
+    if args.metrics is None:
+        modes[args.mode](args)
+        return
+    # Collect timers and counters of pipeline stages and save them even if the mode fails
+    from src.instrumentation import metrics
+    metrics.enable()
+    try:
+        modes[args.mode](args)
+    finally:
+        metrics.export(args.metrics, args.metrics_format, labels={'mode': args.mode})
 
 
-main()
+if __name__ == '__main__':
+    main()
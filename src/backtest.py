@@ -0,0 +1,80 @@
+import time
+import typing
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from src.utils import data_to_xy
+from src.model import ModelPipeline
+
+# Windows of data and pipeline factory of the current worker process
+_worker_state = {}
+
+
+def _init_worker(windows: list[pd.DataFrame], make_pipeline: typing.Callable[[], ModelPipeline]):
+    """
+    Receive windows of data once per worker process
+
+    :param windows: windows of data in time order
+    :param make_pipeline: function which creates a pipeline without saved state
+    """
+    _worker_state['windows'] = windows
+    _worker_state['make_pipeline'] = make_pipeline
+
+
+def _run_window(k: int, target: str, time_stamp: str, history: typing.Optional[int]) -> dict[str, typing.Any]:
+    """
+    Train a new pipeline on windows before window k and evaluate it on window k
+
+    :param k: number of test window
+    :param target: name of target column
+    :param time_stamp: name of column with time stamps
+    :param history: number of training windows (None for all previous windows)
+    :return: results of the window
+    """
+    windows = _worker_state['windows']
+    start = 0 if history is None else max(k - history, 0)
+    train_x, train_y = data_to_xy(pd.concat(windows[start:k], axis=0), target)
+    test_x, test_y = data_to_xy(windows[k], target)
+
+    pipeline = _worker_state['make_pipeline']()
+    fit_start = time.perf_counter()
+    pipeline.fit(train_x, train_y)
+    eval_start = time.perf_counter()
+    score = pipeline.eval(test_x, test_y)
+    eval_end = time.perf_counter()
+
+    return {'window': k, 'start': str(test_x[time_stamp].iloc[0]), 'end': str(test_x[time_stamp].iloc[-1]),
+            'n_train': train_x.shape[0], 'n_test': test_x.shape[0], 'score': score,
+            'fit_seconds': eval_start - fit_start, 'eval_seconds': eval_end - eval_start}
+
+
+def walk_forward(windows: list[pd.DataFrame], make_pipeline: typing.Callable[[], ModelPipeline], target: str,
+                 time_stamp: str, history: int = None, n_windows: int = None,
+                 n_workers=1) -> typing.Iterator[dict[str, typing.Any]]:
+    """
+    Walk-forward backtest: for each window k > 0, a new pipeline is trained on previous windows
+    and evaluated on window k. Windows are independent, so they are processed in parallel.
+    Pipelines keep their state in memory only
+
+    :param windows: windows of data in time order (e.g. months)
+    :param make_pipeline: function which creates a pipeline without saved state (picklable)
+    :param target: name of target column
+    :param time_stamp: name of column with time stamps
+    :param history: number of the latest windows used for training (None for all previous windows)
+    :param n_windows: maximum number of test windows (None for all)
+    :param n_workers: number of worker processes
+    :return: iterator over results of windows in time order
+    """
+    tests = range(1, len(windows) if n_windows is None else min(n_windows + 1, len(windows)))
+    if n_workers <= 1:
+        _init_worker(windows, make_pipeline)
+        for k in tests:
+            yield _run_window(k, target, time_stamp, history)
+        return
+
+    # Windows are sent to every worker once; tasks are only numbers of windows
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(windows, make_pipeline)) as pool:
+        # Later windows have more training data, so they are submitted first
+        futures = {k: pool.submit(_run_window, k, target, time_stamp, history) for k in reversed(tests)}
+        for k in tests:
+            yield futures[k].result()
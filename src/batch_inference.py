@@ -0,0 +1,90 @@
+import collections
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from src.utils import xy_to_data
+from src.checkpoint_store import CheckpointStore
+from src.column_cache import ColumnCache
+from src.compiled_forest import CompiledForest
+from src.instrumentation import metrics
+
+# Fitted transformer and model (or predictor compiled from it) of the current worker process
+_worker_state = {}
+
+
+def _init_worker(path_to_save: str):
+    """
+    Load fitted transformer and the predictor compiled by export (or memory-mapped model) once per worker process
+
+    :param path_to_save: path to directory with ModelPipeline state
+    """
+    store = CheckpointStore(path_to_save)
+    _worker_state['transformer'] = store.load_meta()['transformer']
+    path = store.compiled_path()
+    if path is not None:
+        # Compiled predictor needs only numpy, so sklearn is not loaded
+        _worker_state['forest'] = CompiledForest.load(path)
+        _worker_state['model'] = None
+    else:
+        _worker_state['forest'] = None
+        _worker_state['model'] = store.load_model(mmap_mode='r')
+
+
+def _predict_chunk(x: pd.DataFrame) -> pd.DataFrame:
+    """
+    Make predictions for a chunk of data
+
+    :param x: features
+    :return: processed features with predictions
+    """
+    with metrics.timer('predict'):
+        prepared, _ = _worker_state['transformer'].prepare_pred(x)
+        forest, model = _worker_state['forest'], _worker_state['model']
+        if forest is not None:
+            # Compiled predictor selects input columns by name, so their order in the file does not matter
+            y = forest.predict(x)
+            assert y.index.equals(prepared.index)
+        else:
+            # Model trained on a matrix has no feature names
+            features = prepared if hasattr(model, 'feature_names_in_') else prepared.to_numpy(dtype=np.float32)
+            y = pd.DataFrame({'predicted': model.predict(features) if not prepared.empty else []},
+                             index=prepared.index)
+    return xy_to_data(prepared, y)
+
+
+def predict_file(path_to_data: str, path_to_out: str, path_to_save: str, chunk_size=10000, n_workers=1,
+                 cache: ColumnCache = None):
+    """
+    Make predictions for a CSV file chunk by chunk and write them to a CSV file in the original order
+
+    :param path_to_data: path to CSV file with features
+    :param path_to_out: path to output CSV file
+    :param path_to_save: path to directory with ModelPipeline state
+    :param chunk_size: number of rows processed at once
+    :param n_workers: number of worker processes
+    :param cache: columnar cache of the file (chunks are read from it instead of being parsed)
+    """
+    reader = pd.read_csv(path_to_data, chunksize=chunk_size) if cache is None else cache.chunks(chunk_size)
+    header = True
+
+    def write(xy: pd.DataFrame):
+        nonlocal header
+        xy.to_csv(path_to_out, mode='w' if header else 'a', header=header)
+        header = False
+
+    if n_workers <= 1:
+        _init_worker(path_to_save)
+        for chunk in reader:
+            write(_predict_chunk(chunk))
+        return
+
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(path_to_save,)) as pool:
+        # Keep a bounded number of chunks in flight and write them as soon as all previous chunks are written
+        pending = collections.deque()
+        for chunk in reader:
+            pending.append(pool.submit(_predict_chunk, chunk))
+            if len(pending) >= 2 * n_workers:
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
@@ -0,0 +1,211 @@
+import os
+import re
+import typing
+import numpy as np
+import pandas as pd
+
+from src.utils import read, save, replace_atomically
+from src.schema import is_categorical
+
+
+class CheckpointStore:
+    def __init__(self, path_to_save: str):
+        """
+        CheckpointStore saves state of ModelPipeline to a directory:
+        received data is appended as columnar segments (one file per batch),
+        model is saved to a new versioned file which can be memory-mapped,
+        other state is saved to a small metadata file which refers to the model file.
+        Every file is written atomically; replacing the metadata file is the only commit point,
+        so a model and a transformer from different checkpoints are never loaded together
+
+        :param path_to_save: path to directory with state
+        """
+        self.path_to_save = path_to_save
+        self.path_to_data = os.path.join(path_to_save, 'data')
+        self.path_to_meta = os.path.join(path_to_save, 'meta.pkl')
+        self.n_segments = 0  # Number of committed data segments
+        self.model_file = None  # Model file of the loaded or the last committed checkpoint
+        self.new_model_file = None  # Model file written after the last commit
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path_to_meta)
+
+    def has_model(self) -> bool:
+        """
+        Check whether the committed state has a model (metadata is loaded if it is not loaded yet)
+        """
+        if self.model_file is None and self.exists():
+            self.load_meta()
+        return self.model_file is not None and os.path.exists(self.__model_path(self.model_file))
+
+    def __model_path(self, name: str) -> str:
+        return os.path.join(self.path_to_save, name)
+
+    def __model_files(self) -> dict[str, int]:
+        """
+        Find versioned model files (committed or not)
+
+        :return: dict {file name: version}
+        """
+        files = {}
+        for name in os.listdir(self.path_to_save):
+            match = re.fullmatch(r'model-(\d+)\.joblib', name)
+            if match is not None:
+                files[name] = int(match.group(1))
+        return files
+
+    def __segment_path(self, k: int) -> str:
+        return os.path.join(self.path_to_data, f'{k:08}.npz')
+
+    @staticmethod
+    def __frame_to_arrays(df: pd.DataFrame, prefix: str) -> dict[str, np.ndarray]:
+        arrays = {f'{prefix}columns': np.asarray(df.columns, dtype=str)}
+        for i, col in enumerate(df.columns):
+            values = df[col]
+            if is_categorical(values):
+                # Categories used in the segment and their codes (-1 for missing values)
+                codes, categories = pd.factorize(values)
+                arrays[f'{prefix}{i}'] = np.asarray(categories, dtype=str)
+                arrays[f'{prefix}{i}_codes'] = codes.astype(np.int32)
+            else:
+                arrays[f'{prefix}{i}'] = values.to_numpy()
+        return arrays
+
+    @staticmethod
+    def __arrays_to_frame(arrays: typing.Mapping[str, np.ndarray], prefix: str, index: np.ndarray) -> pd.DataFrame:
+        data = {}
+        for i, col in enumerate(arrays[f'{prefix}columns']):
+            values = arrays[f'{prefix}{i}']
+            if f'{prefix}{i}_codes' in arrays:
+                values = pd.Categorical.from_codes(arrays[f'{prefix}{i}_codes'], categories=values.astype(object))
+            elif f'{prefix}{i}_na' in arrays:  # Segment written by an older version
+                values = np.where(arrays[f'{prefix}{i}_na'], np.nan, values.astype(object))
+            data[str(col)] = values
+        return pd.DataFrame(data, index=index)
+
+    def append_data(self, x: pd.DataFrame, y: pd.DataFrame):
+        """
+        Write new data segment. It becomes a part of the state after commit
+
+        :param x: x
+        :param y: y
+        """
+        os.makedirs(self.path_to_data, exist_ok=True)
+        arrays = {'index': x.index.to_numpy()}
+        arrays.update(self.__frame_to_arrays(x, 'x'))
+        arrays.update(self.__frame_to_arrays(y, 'y'))
+        with replace_atomically(self.__segment_path(self.n_segments + 1)) as tmp_path:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+        self.n_segments += 1
+
+    def read_data(self, segments: range = None) -> typing.Iterator[tuple[pd.DataFrame, pd.DataFrame]]:
+        """
+        Read committed data segments
+
+        :param segments: numbers of segments to read (all committed segments by default)
+        :return: iterator over segments (x, y)
+        """
+        for k in range(1, self.n_segments + 1) if segments is None else segments:
+            with np.load(self.__segment_path(k)) as arrays:
+                index = arrays['index']
+                yield self.__arrays_to_frame(arrays, 'x', index), self.__arrays_to_frame(arrays, 'y', index)
+
+    def segment_sizes(self) -> list[int]:
+        """
+        Get numbers of rows of committed data segments (only the index of each segment is read)
+
+        :return: sizes of segments 1, 2, ...
+        """
+        sizes = []
+        for k in range(1, self.n_segments + 1):
+            with np.load(self.__segment_path(k)) as arrays:
+                sizes.append(arrays['index'].shape[0])
+        return sizes
+
+    def save_model(self, model: typing.Any):
+        """
+        Write model to a new file. It becomes a part of the state after commit
+
+        :param model: model
+        """
+        import joblib
+
+        os.makedirs(self.path_to_save, exist_ok=True)
+        version = max(self.__model_files().values(), default=0) + 1
+        self.new_model_file = f'model-{version}.joblib'
+        with replace_atomically(self.__model_path(self.new_model_file)) as tmp_path:
+            joblib.dump(model, tmp_path)
+
+    def load_model(self, mmap_mode: str = None) -> typing.Any:
+        """
+        Load model of the loaded checkpoint (see load_meta)
+
+        :param mmap_mode: None to read model into memory, 'r' to memory-map its arrays
+        :return: model (None if there is no model or it has been removed by a newer commit)
+        """
+        import joblib
+
+        if self.model_file is None:
+            return None
+        try:
+            return joblib.load(self.__model_path(self.model_file), mmap_mode=mmap_mode)
+        except FileNotFoundError:
+            return None
+
+    def __compiled_path(self, model_file: str) -> str:
+        return self.__model_path(os.path.splitext(model_file)[0] + '.npz')
+
+    def save_compiled(self, forest: typing.Any):
+        """
+        Save predictor compiled from the model of the loaded checkpoint (see CompiledForest).
+        Inference uses it instead of the model, so that sklearn is not loaded
+
+        :param forest: compiled predictor
+        """
+        assert self.model_file is not None
+        with replace_atomically(self.__compiled_path(self.model_file)) as tmp_path:
+            forest.save(tmp_path)
+
+    def compiled_path(self) -> typing.Optional[str]:
+        """
+        Get path to the predictor compiled from the model of the loaded checkpoint (see load_meta)
+
+        :return: path (None if the model has not been compiled)
+        """
+        if self.model_file is None:
+            return None
+        path = self.__compiled_path(self.model_file)
+        return path if os.path.exists(path) else None
+
+    def commit(self, meta: dict[str, typing.Any]):
+        """
+        Save metadata and make written data segments and model a part of the state.
+        Older model files (and predictors compiled from them) are removed afterwards except the previous one, which readers may still be loading
+
+        :param meta: small part of the state
+        """
+        os.makedirs(self.path_to_save, exist_ok=True)
+        previous = self.model_file
+        if self.new_model_file is not None:
+            self.model_file, self.new_model_file = self.new_model_file, None
+        save(self.path_to_meta, {**meta, 'n_segments': self.n_segments, 'model': self.model_file})
+
+        keep = {self.model_file, previous}
+        for name in list(self.__model_files()) + ['model.joblib']:  # model.joblib is saved by an older version
+            if name not in keep:
+                for path in [self.__model_path(name), self.__compiled_path(name)]:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def load_meta(self) -> dict[str, typing.Any]:
+        """
+        Load metadata. Data segments written after the last commit are ignored
+
+        :return: metadata
+        """
+        meta = read(self.path_to_meta)
+        self.n_segments = meta['n_segments']
+        # State saved by an older version has a single model file
+        self.model_file = meta.get('model', 'model.joblib')
+        return meta
@@ -0,0 +1,219 @@
+import os
+import json
+import shutil
+import typing
+import hashlib
+import numpy as np
+import pandas as pd
+
+from src.schema import Schema, is_categorical
+from src.instrumentation import metrics
+
+# Version of the cache format (caches of other versions are rebuilt)
+VERSION = 2
+
+
+class ColumnCache:
+    def __init__(self, path_to_raw_data: str, path_to_save: str, schema: Schema = None, chunk_size=100000):
+        """
+        ColumnCache keeps a CSV file converted to a columnar binary format: one file of raw values per column
+        (categorical columns as int32 codes of the schema dictionary, other columns with the precision
+        pandas parses them with, so that values are the same as values read from the file) and meta.json with types
+        and categories. Column files are memory-mapped,
+        so reading some columns or a range of rows touches only their bytes and nothing is parsed.
+        The cache is built on first use and rebuilt when the source file changes. It is keyed by size,
+        modification time and content hash of the file: if only the modification time differs, the hash decides
+
+        :param path_to_raw_data: path to CSV file
+        :param path_to_save: path to directory with caches (one subdirectory per source file)
+        :param schema: column types (extended with types of the file when the cache is built)
+        :param chunk_size: number of rows parsed at once when the cache is built
+        """
+        self.path_to_raw_data = path_to_raw_data
+        source = os.path.abspath(path_to_raw_data)
+        name = f'{os.path.basename(source)}_{hashlib.sha1(source.encode()).hexdigest()[:12]}'
+        self.path_to_save = os.path.join(path_to_save, name)
+        self.schema = Schema() if schema is None else schema
+        self.chunk_size = chunk_size
+
+        self.n_rows = None
+        self.columns = None
+        self.arrays = None  # Column -> memory-mapped values (codes for categorical columns)
+        self.dtypes = None  # Categorical column -> categorical dtype
+
+    def __path(self, name: str) -> str:
+        return os.path.join(self.path_to_save, name)
+
+    def __hash_source(self) -> str:
+        h = hashlib.sha1()
+        with open(self.path_to_raw_data, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def __is_valid(self, meta: dict[str, typing.Any]) -> bool:
+        """
+        Check whether the cache was built from the current version of the source file
+        (and refresh the modification time of the key if the file was touched without changes)
+
+        :param meta: meta information of the cache
+        :return: True if the cache is valid
+        """
+        stat = os.stat(self.path_to_raw_data)
+        source = meta['source']
+        if meta.get('version') != VERSION:
+            return False
+        if source['size'] != stat.st_size:
+            return False
+        if source['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        if source['sha1'] != self.__hash_source():
+            return False
+        source['mtime_ns'] = stat.st_mtime_ns
+        self.__write_meta(self.path_to_save, meta)
+        return True
+
+    @staticmethod
+    def __write_meta(path: str, meta: dict[str, typing.Any]):
+        tmp_fn = os.path.join(path, f'meta.json.{os.getpid()}.tmp')
+        with open(tmp_fn, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_fn, os.path.join(path, 'meta.json'))
+
+    def __build(self):
+        """
+        Convert the source file. The file is parsed twice chunk by chunk: the first pass extends the schema
+        with all categories and finds types holding values of all chunks, the second one writes the values
+        """
+        stat = os.stat(self.path_to_raw_data)
+        source = {'path': os.path.abspath(self.path_to_raw_data), 'size': stat.st_size,
+                  'mtime_ns': stat.st_mtime_ns, 'sha1': self.__hash_source()}
+        source_dtypes = {}  # Non-categorical column -> type holding values parsed from all chunks
+        for chunk in pd.read_csv(self.path_to_raw_data, chunksize=self.chunk_size, dtype=self.schema.csv_dtypes()):
+            self.schema.apply(chunk)
+            for col, values in chunk.items():
+                if is_categorical(values):
+                    continue
+                source_dtypes[col] = np.result_type(source_dtypes.get(col, values.dtype), values.dtype)
+
+        tmp_path = f'{self.path_to_save}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        columns = None
+        files = {}
+        n_rows = 0
+        try:
+            for chunk in pd.read_csv(self.path_to_raw_data, chunksize=self.chunk_size,
+                                     dtype=self.schema.csv_dtypes()):
+                if columns is None:
+                    columns = []
+                    for i, col in enumerate(chunk.columns):
+                        dtype = self.schema.dtypes.get(col)
+                        categorical = isinstance(dtype, pd.CategoricalDtype)
+                        columns.append({'name': col, 'file': f'{i}.bin',
+                                        'dtype': np.dtype(np.int32 if categorical else source_dtypes[col]).str,
+                                        'categories': dtype.categories.tolist() if categorical else None})
+                        files[col] = open(os.path.join(tmp_path, f'{i}.bin'), 'wb')
+                # Only categorical columns are converted (to codes of the schema dictionary)
+                categorical = self.schema.cast(chunk[[column['name'] for column in columns
+                                                      if column['categories'] is not None]])
+                for column in columns:
+                    if column['categories'] is not None:
+                        values = categorical[column['name']].cat.codes
+                    else:
+                        values = chunk[column['name']]
+                    files[column['name']].write(values.to_numpy(dtype=column['dtype']).tobytes())
+                n_rows += chunk.shape[0]
+        finally:
+            for f in files.values():
+                f.close()
+        self.__write_meta(tmp_path, {'version': VERSION, 'source': source, 'n_rows': n_rows,
+                                     'columns': columns or []})
+
+        shutil.rmtree(self.path_to_save, ignore_errors=True)
+        os.makedirs(os.path.dirname(self.path_to_save) or '.', exist_ok=True)
+        os.replace(tmp_path, self.path_to_save)
+
+    def open(self):
+        """
+        Open the cache, building it if it is missing or outdated. It is done automatically on first read
+        """
+        if self.arrays is not None:
+            return
+        with metrics.timer('column_cache'):
+            try:
+                with open(self.__path('meta.json')) as f:
+                    meta = json.load(f)
+                valid = self.__is_valid(meta)
+            except FileNotFoundError:
+                valid = False
+            if not valid:
+                self.__build()
+                with open(self.__path('meta.json')) as f:
+                    meta = json.load(f)
+
+            self.n_rows = meta['n_rows']
+            self.columns = [column['name'] for column in meta['columns']]
+            self.arrays = {}
+            self.dtypes = {}
+            for column in meta['columns']:
+                dtype = np.dtype(column['dtype'])
+                if self.n_rows == 0:
+                    self.arrays[column['name']] = np.empty(0, dtype=dtype)
+                else:
+                    self.arrays[column['name']] = np.memmap(self.__path(column['file']), dtype=dtype, mode='r',
+                                                            shape=(self.n_rows,))
+                if column['categories'] is not None:
+                    self.dtypes[column['name']] = pd.CategoricalDtype(pd.Index(column['categories'], dtype=object))
+
+    def __len__(self) -> int:
+        self.open()
+        return self.n_rows
+
+    def read(self, columns: list[str] = None, start=0, stop: int = None) -> pd.DataFrame:
+        """
+        Read a range of rows. Non-categorical columns are read-only views of the memory-mapped files
+
+        :param columns: columns to read (all columns by default)
+        :param start: index of the first row
+        :param stop: index after the last row (the end of data by default)
+        :return: data indexed by row numbers, as read by pandas
+        """
+        self.open()
+        stop = self.n_rows if stop is None else min(stop, self.n_rows)
+        start = min(start, stop)
+        data = {}
+        for col in self.columns if columns is None else columns:
+            values = self.arrays[col][start:stop]
+            if col in self.dtypes:
+                values = pd.Categorical.from_codes(values, dtype=self.dtypes[col])
+            data[col] = values
+        return pd.DataFrame(data, index=pd.RangeIndex(start, stop), copy=False)
+
+    def take(self, rows: np.ndarray, columns: list[str] = None) -> pd.DataFrame:
+        """
+        Read rows with the given numbers (e.g. rows of a time window which are not contiguous in the file)
+
+        :param rows: numbers of rows
+        :param columns: columns to read (all columns by default)
+        :return: data indexed by row numbers
+        """
+        self.open()
+        data = {}
+        for col in self.columns if columns is None else columns:
+            values = self.arrays[col][rows]
+            if col in self.dtypes:
+                values = pd.Categorical.from_codes(values, dtype=self.dtypes[col])
+            data[col] = values
+        return pd.DataFrame(data, index=pd.Index(rows), copy=False)
+
+    def chunks(self, chunk_size: int, columns: list[str] = None) -> typing.Iterator[pd.DataFrame]:
+        """
+        Read data chunk by chunk (like pandas.read_csv with chunksize)
+
+        :param chunk_size: number of rows in a chunk
+        :param columns: columns to read (all columns by default)
+        :return: iterator over chunks
+        """
+        for start in range(0, len(self), chunk_size):
+            yield self.read(columns, start, start + chunk_size)
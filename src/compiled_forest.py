@@ -0,0 +1,245 @@
+import numpy as np
+import pandas as pd
+
+from src.data_transformer import DataTransformer
+from src.schema import get_indexer
+
+# Batches up to this size look categories up in dicts, larger batches use vectorized lookup of pandas
+SMALL_BATCH = 64
+
+
+class CompiledForest:
+    def __init__(self, transformer: DataTransformer = None, model=None):
+        """
+        CompiledForest is a low-latency predictor made from a fitted DataTransformer and RandomForestClassifier.
+        Nodes of all trees are stored in flat contiguous arrays and all trees are walked for the whole batch at once;
+        categorical features are one-hot encoded by writing category codes directly into the feature matrix.
+        Predictions are the same as predictions of the model for data prepared by the transformer
+
+        :param transformer: fitted transformer (None for an empty predictor filled by load)
+        :param model: fitted RandomForestClassifier
+        """
+        self.na_method = None
+        self.num_cols = None  # Numeric columns of input data
+        self.ctg_cols = None  # Categorical columns of input data
+        self.categories = None  # Known categories of each categorical column
+        self.codes = None  # Codes of known categories of each categorical column
+        self.num_fill = None  # Values replacing missing values of numeric columns (None for medians of the batch)
+        self.ctg_fill = None  # Codes replacing missing values of categorical columns (-1 for no replacement)
+        self.num_pos = None  # Positions of numeric columns in the feature matrix
+        self.ctg_pos = None  # Positions of encoded categories in the feature matrix (one array per categorical column)
+        self.n_features = 0
+        self.classes = None
+
+        # Nodes of all trees. Leaves point to themselves, so walking a tree deeper than the leaf keeps the leaf
+        self.roots = None
+        self.feature = None
+        self.threshold = None
+        self.left = None
+        self.right = None
+        self.missing_left = None  # Whether samples with missing value of the feature go to the left child
+        self.value = None  # Class probabilities of nodes
+        self.depth = 0
+
+        if transformer is not None:
+            self.__compile(transformer, model)
+
+    def __compile(self, transformer: DataTransformer, model):
+        assert transformer.ctg_method == 'ohe'
+
+        # Feature matrix layout (a model trained on a matrix has no feature names, so they are taken from transformer)
+        feature_names = transformer.feature_names if transformer.feature_names is not None else model.feature_names_in_
+        positions = {name: i for i, name in enumerate(feature_names)}
+        encoded_cols = transformer.encoded_cols
+        self.na_method = transformer.na_method
+        self.ctg_cols = list(transformer.ctg_cols)
+        self.num_cols = [col for col in feature_names if col not in set(encoded_cols)]
+        self.categories = list(transformer.ctg_index)
+        self.codes = [dict(zip(categories, range(len(categories)))) for categories in self.categories]
+        if transformer.na_method == 'median-mode' and transformer.fill_values is not None:
+            fill = transformer.fill_values
+            self.num_fill = np.array([fill.get(col, np.nan) for col in self.num_cols], dtype=np.float64)
+            self.ctg_fill = np.array([self.codes[j].get(fill.get(col), -1) for j, col in enumerate(self.ctg_cols)],
+                                     dtype=np.int64)
+        self.num_pos = np.array([positions[col] for col in self.num_cols], dtype=np.int64)
+        self.ctg_pos = np.split(np.array([positions[col] for col in encoded_cols], dtype=np.int64),
+                                np.cumsum([len(categories) for categories in self.categories])[:-1])
+        self.n_features = len(feature_names)
+        self.classes = model.classes_
+
+        # Flat arrays of nodes
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        offsets = np.concatenate(([0], np.cumsum([tree.node_count for tree in trees])))
+        self.roots = offsets[:-1].astype(np.int64)
+        ids = np.arange(offsets[-1])
+        self.feature = np.concatenate([tree.feature for tree in trees]).astype(np.int64)
+        self.threshold = np.concatenate([tree.threshold for tree in trees]).astype(np.float64)
+        self.left = np.concatenate([tree.children_left + offset for tree, offset in zip(trees, offsets)])
+        self.right = np.concatenate([tree.children_right + offset for tree, offset in zip(trees, offsets)])
+        self.missing_left = np.concatenate([getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, dtype=bool))
+                                            for tree in trees]).astype(bool)
+        leaves = self.feature < 0
+        self.feature[leaves] = 0
+        self.left[leaves] = ids[leaves]
+        self.right[leaves] = ids[leaves]
+        # Normalize class weights of nodes as DecisionTreeClassifier.predict_proba does
+        value = np.concatenate([tree.value[:, 0, :len(self.classes)] for tree in trees]).astype(np.float64)
+        normalizer = value.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0] = 1
+        self.value = value / normalizer
+        self.depth = max(tree.max_depth for tree in trees)
+
+    def __lookup(self, j: int, values: pd.Series) -> np.ndarray:
+        """
+        Look up codes of categories of a categorical column
+
+        :param j: number of categorical column
+        :param values: values of the column
+        :return: codes (-1 for unknown categories)
+        """
+        if values.shape[0] <= SMALL_BATCH:
+            return np.fromiter((self.codes[j].get(value, -1) for value in values.to_numpy()), dtype=np.int64,
+                               count=values.shape[0])
+        return get_indexer(self.categories[j], values)
+
+    def transform(self, x: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Build feature matrix the same way as DataTransformer.prepare_pred does
+
+        :param x: features
+        :return: (feature matrix, mask of rows which are not removed)
+        """
+        n = x.shape[0]
+        numeric = x[self.num_cols].to_numpy(dtype=np.float64)
+        keep = np.ones(n, dtype=bool)
+        na = np.isnan(numeric)
+        if self.na_method == 'drop':
+            keep &= ~na.any(axis=1)
+        elif na.any():
+            cols = np.flatnonzero(na.any(axis=0))
+            if self.num_fill is not None:
+                # Missing values are replaced with medians of training data
+                fill = self.num_fill[cols]
+            else:
+                # Missing values are replaced with medians of the batch
+                fill = np.nanmedian(numeric[:, cols], axis=0)
+            numeric[:, cols] = np.where(na[:, cols], fill, numeric[:, cols])
+
+        codes = np.empty((n, len(self.ctg_cols)), dtype=np.int64)
+        for j, col in enumerate(self.ctg_cols):
+            values = x[col]
+            codes[:, j] = self.__lookup(j, values)
+            # Missing values are not among known categories, so they are looked for among unknown values only
+            if (codes[:, j] < 0).any() and values.isna().any():
+                if self.na_method == 'drop':
+                    keep &= values.notna().to_numpy()
+                elif self.ctg_fill is not None:
+                    # Missing values are replaced with the mode of training data
+                    codes[values.isna().to_numpy(), j] = self.ctg_fill[j]
+                else:
+                    # Missing values are replaced with the mode of the batch
+                    mode = values.mode()
+                    if not mode.empty:
+                        codes[:, j] = self.__lookup(j, values.fillna(mode.iloc[0]))
+        keep &= (codes >= 0).all(axis=1)
+
+        matrix = np.zeros((int(keep.sum()), self.n_features), dtype=np.float32)
+        matrix[:, self.num_pos] = numeric[keep]
+        rows = np.arange(matrix.shape[0])
+        for j, positions in enumerate(self.ctg_pos):
+            matrix[rows, positions[codes[keep, j]]] = 1
+        return matrix, keep
+
+    def predict_proba_matrix(self, matrix: np.ndarray) -> np.ndarray:
+        """
+        Predict class probabilities for a prepared feature matrix
+
+        :param matrix: feature matrix (float32, as the model casts its input)
+        :return: class probabilities
+        """
+        n = matrix.shape[0]
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        has_na = np.isnan(matrix).any()
+        # Values of sample i are looked up in the flattened matrix at i * n_features + feature
+        row_offsets = (np.arange(n) * matrix.shape[1])[:, None]
+        flat = matrix.ravel()
+        node = np.broadcast_to(self.roots, (n, self.roots.shape[0])).copy()
+        for _ in range(self.depth):
+            values = flat[row_offsets + self.feature[node]]
+            go_left = values <= self.threshold[node]
+            if has_na:
+                go_left = np.where(np.isnan(values), self.missing_left[node], go_left)
+            node = np.where(go_left, self.left[node], self.right[node])
+
+        # Average probabilities of trees in the same order as the model does
+        proba = np.zeros((n, self.classes.shape[0]), dtype=np.float64)
+        for t in range(node.shape[1]):
+            proba += self.value[node[:, t]]
+        proba /= node.shape[1]
+        return proba
+
+    def predict_matrix(self, matrix: np.ndarray) -> np.ndarray:
+        return self.classes.take(np.argmax(self.predict_proba_matrix(matrix), axis=1), axis=0)
+
+    def predict(self, x: pd.DataFrame) -> pd.DataFrame:
+        """
+        Make predictions
+
+        :param x: features
+        :return: predictions of rows which are not removed by the transformer
+        """
+        matrix, keep = self.transform(x)
+        return pd.DataFrame({'predicted': self.predict_matrix(matrix)}, index=x.index[keep])
+
+    def save(self, path: str):
+        """
+        Save predictor to a NumPy archive
+
+        :param path: path to file
+        """
+        arrays = {name: getattr(self, name) for name in ['num_pos', 'classes', 'roots', 'feature', 'threshold',
+                                                           'left', 'right', 'missing_left', 'value']}
+        arrays['na_method'] = np.array(self.na_method)
+        if self.num_fill is not None:
+            arrays['num_fill'] = self.num_fill
+            arrays['ctg_fill'] = self.ctg_fill
+        arrays['num_cols'] = np.array(self.num_cols, dtype=str)
+        arrays['ctg_cols'] = np.array(self.ctg_cols, dtype=str)
+        arrays['shape'] = np.array([self.n_features, self.depth])
+        # Categories keep their values and types (e.g. missing values, numbers and booleans are not turned into strings)
+        arrays['category_dtypes'] = np.array([str(categories.dtype) for categories in self.categories], dtype=str)
+        for j in range(len(self.ctg_cols)):
+            arrays[f'categories{j}'] = self.categories[j].to_numpy(dtype=object)
+            arrays[f'ctg_pos{j}'] = self.ctg_pos[j]
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load(path: str) -> 'CompiledForest':
+        """
+        Load predictor saved by save. Categories are stored as pickled objects, so only trusted files should be loaded
+
+        :param path: path to file
+        :return: predictor
+        """
+        forest = CompiledForest()
+        with np.load(path, allow_pickle=True) as arrays:
+            for name in ['num_pos', 'classes', 'roots', 'feature', 'threshold', 'left', 'right', 'missing_left',
+                         'value']:
+                setattr(forest, name, arrays[name])
+            forest.na_method = str(arrays['na_method'])
+            if 'num_fill' in arrays:
+                forest.num_fill = arrays['num_fill']
+                forest.ctg_fill = arrays['ctg_fill']
+            forest.num_cols = arrays['num_cols'].tolist()
+            forest.ctg_cols = arrays['ctg_cols'].tolist()
+            forest.n_features, forest.depth = arrays['shape'].tolist()
+            if 'category_dtypes' in arrays:
+                forest.categories = [pd.Index(arrays[f'categories{j}'], dtype=dtype)
+                                     for j, dtype in enumerate(arrays['category_dtypes'].tolist())]
+            else:  # Predictor saved by an older version (categories as strings)
+                forest.categories = [pd.Index(arrays[f'categories{j}'].astype(object))
+                                     for j in range(len(forest.ctg_cols))]
+            forest.codes = [dict(zip(categories, range(len(categories)))) for categories in forest.categories]
+            forest.ctg_pos = [arrays[f'ctg_pos{j}'] for j in range(len(forest.ctg_cols))]
+        return forest
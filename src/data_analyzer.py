@@ -1,15 +1,119 @@
+import copy
 import typing
+import numpy as np
 import pandas as pd
 
+from src.utils import read, save
+from src.schema import categorical_columns
+from src.sketches import QuantileSketch, HeavyHitters
+from src.instrumentation import metrics
+
 
 class DataAnalyzer:
-    def __init__(self):
+    def __init__(self, path_to_save: str = None, sketch_size=200, n_counters=100, autosave=True):
         """
-        DataAnalyzer analyzes data
+        DataAnalyzer analyzes data.
+        Besides statistics of each batch, it keeps running statistics of the whole stream in constant memory
+
+        :param path_to_save: path to file with DataAnalyzer state (None for no saving)
+        :param sketch_size: number of centroids of quantile sketches (used for medians)
+        :param n_counters: number of counters of frequent values (used for modes)
+        :param autosave: if False, state is saved only by commit (e.g. when batches are analyzed ahead of training)
         """
+        self.path_to_save = path_to_save
+        self.autosave = autosave
+        self.sketch_size = sketch_size
+        self.n_counters = n_counters
         self.data = None
         self.stat = {}
 
+        # Running statistics
+        self.categorical_cols = None
+        self.noncategorical_cols = None
+        self.n_rows = 0
+        self.n_rows_with_na = 0
+        self.na_counts = None
+        self.counts = None  # Number of non-missing values of non-categorical columns
+        self.means = None
+        self.m2 = None  # Sums of squared deviations from the means
+        self.sketches = {}
+        self.counters = {}
+
+        self.__load_state()
+
+    def __load_state(self):
+        if self.path_to_save is None:
+            return
+        try:
+            self.__dict__.update(read(self.path_to_save))
+        except FileNotFoundError:
+            pass
+
+    def __save_state(self):
+        if self.autosave:
+            self.commit()
+
+    def state(self) -> dict[str, typing.Any]:
+        """
+        Get a copy of the state (running statistics)
+
+        :return: state
+        """
+        state = self.__dict__.copy()
+        del state['data'], state['stat'], state['path_to_save'], state['autosave']
+        return copy.deepcopy(state)
+
+    def commit(self, state: dict[str, typing.Any] = None):
+        """
+        Save state
+
+        :param state: state returned by state() earlier (the current state by default)
+        """
+        if self.path_to_save is not None:
+            save(self.path_to_save, self.state() if state is None else state)
+
+    def __init_running(self, categorical_cols: list[str], noncategorical_cols: list[str], columns: pd.Index):
+        self.categorical_cols = categorical_cols
+        self.noncategorical_cols = noncategorical_cols
+        self.na_counts = pd.Series(0, index=columns)
+        n = len(self.noncategorical_cols)
+        self.counts, self.means, self.m2 = np.zeros(n), np.zeros(n), np.zeros(n)
+        self.sketches = {col: QuantileSketch(self.sketch_size) for col in self.noncategorical_cols}
+        self.counters = {col: HeavyHitters(self.n_counters) for col in self.categorical_cols}
+
+    def __merge_moments(self, counts: np.ndarray, means: np.ndarray, m2: np.ndarray):
+        """
+        Combine running mean and variance with those of another part of the stream (parallel Welford algorithm)
+        """
+        total = self.counts + counts
+        delta = means - self.means
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(total > 0, counts / total, 0)
+        self.means = self.means + delta * weight
+        self.m2 = self.m2 + np.nan_to_num(m2) + delta ** 2 * self.counts * weight
+        self.counts = total
+
+    def __update_running(self):
+        """
+        Add the current batch to running statistics
+        """
+        na = self.data.isna()
+        self.n_rows += self.data.shape[0]
+        self.n_rows_with_na += int(na.any(axis=1).sum())
+        self.na_counts = self.na_counts.add(na.sum(axis=0), fill_value=0)
+
+        values = self.data[self.noncategorical_cols].to_numpy(dtype=np.float64)
+        counts = (~np.isnan(values)).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.nansum(values, axis=0) / counts
+        m2 = np.nansum((values - means) ** 2, axis=0)
+        self.__merge_moments(counts, np.nan_to_num(means), m2)
+
+        for j, col in enumerate(self.noncategorical_cols):
+            self.sketches[col].update(values[:, j])
+        for col in self.categorical_cols:
+            self.counters[col].update(self.data[col])
+
     def __analyze_na(self):
         """
         Collect statistics on missing values
@@ -23,9 +127,8 @@ class DataAnalyzer:
         """
         Collect statistics on completed values
         """
-        categorical_cols = self.data.dtypes[self.data.dtypes == 'object'].index.tolist()
-        categorical = self.data[categorical_cols]
-        noncategorical = self.data.drop(categorical_cols, axis=1)
+        categorical = self.data[self.categorical_cols]
+        noncategorical = self.data[self.noncategorical_cols]
         self.stat['ctg_modes'] = categorical.mode(axis=0).to_numpy()[0]
         self.stat['num_medians'] = noncategorical.median()
         self.stat['num_means'] = noncategorical.mean()
@@ -33,16 +136,66 @@ class DataAnalyzer:
 
     def analyze(self, df: pd.DataFrame) -> dict[str, typing.Any]:
         """
-        Analyze data
+        Analyze data and add it to running statistics
 
         :param df: data
         :return: dict with information about data. Dict contains 'na' and 'ctg' keys
         """
-        self.data = df.copy()
-        self.stat = {}
+        with metrics.timer('analyze'):
+            self.data = df
+            self.stat = {}
+            if self.categorical_cols is None:
+                categorical_cols = categorical_columns(df)
+                self.__init_running(categorical_cols, [col for col in df.columns if col not in categorical_cols],
+                                    df.columns)
 
-        # Analyze missing values
-        self.__analyze_na()
-        self.__analyze_col_stats()
+            # Analyze missing values
+            self.__analyze_na()
+            self.__analyze_col_stats()
+            self.__update_running()
+
+            self.data = None
+            self.__save_state()
+        metrics.count('rows_analyzed', df.shape[0])
 
         return self.stat
+
+    def summary(self) -> dict[str, typing.Any]:
+        """
+        Get statistics of all analyzed data
+
+        :return: dict with the same keys as returned by analyze
+        """
+        if self.categorical_cols is None:
+            return {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variances = np.where(self.counts > 1, self.m2 / (self.counts - 1), np.nan)
+            means = np.where(self.counts > 0, self.means, np.nan)
+        return {
+            'na': {'na_by_col': self.na_counts / self.n_rows, 'rows_with_na': self.n_rows_with_na / self.n_rows},
+            'ctg_modes': np.array([self.counters[col].mode() for col in self.categorical_cols], dtype=object),
+            'num_medians': pd.Series([self.sketches[col].quantile(0.5) for col in self.noncategorical_cols],
+                                     index=self.noncategorical_cols),
+            'num_means': pd.Series(means, index=self.noncategorical_cols),
+            'num_vars': pd.Series(variances, index=self.noncategorical_cols),
+        }
+
+    def merge(self, other: 'DataAnalyzer'):
+        """
+        Add running statistics of another analyzer (e.g. one which processed another shard of data)
+
+        :param other: analyzer
+        """
+        if other.categorical_cols is None:
+            return
+        if self.categorical_cols is None:
+            self.__init_running(other.categorical_cols, other.noncategorical_cols, other.na_counts.index)
+
+        self.n_rows += other.n_rows
+        self.n_rows_with_na += other.n_rows_with_na
+        self.na_counts = self.na_counts.add(other.na_counts, fill_value=0)
+        self.__merge_moments(other.counts, other.means, other.m2)
+        for col in self.noncategorical_cols:
+            self.sketches[col].merge(other.sketches[col])
+        for col in self.categorical_cols:
+            self.counters[col].merge(other.counters[col])
@@ -1,16 +1,233 @@
+import numpy as np
 import pandas as pd
 
+from src.schema import is_categorical
+
+
+class ColumnBuffer:
+    def __init__(self, capacity=1024):
+        """
+        ColumnBuffer stores rows of a data frame in growable typed arrays (one array per column).
+        Categorical values are stored as integer codes of a per-column category table
+
+        :param capacity: initial number of rows
+        """
+        self.capacity = capacity
+        self.start = 0  # Position of the first stored row
+        self.end = 0  # Position after the last stored row
+        self.columns = None
+        self.values = {}  # Column name -> array of values (or codes for categorical columns)
+        self.categories = {}  # Categorical column name -> list of categories
+        self.codes = {}  # Categorical column name -> dict {category: code}
+        self.index = None
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __init_columns(self, df: pd.DataFrame):
+        self.columns = df.columns.tolist()
+        for col in self.columns:
+            if is_categorical(df[col]):
+                self.categories[col] = []
+                self.codes[col] = {}
+                self.values[col] = np.empty(self.capacity, dtype=np.int32)
+            else:
+                self.values[col] = np.empty(self.capacity, dtype=df[col].dtype)
+        self.index = np.empty(self.capacity, dtype=np.int64)
+
+    def __encode(self, col: str, values: pd.Series) -> np.ndarray:
+        """
+        Convert categorical values to codes extending the category table if needed
+
+        :param col: column name
+        :param values: values
+        :return: codes (-1 for missing values)
+        """
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Only categories present in values are looked up
+            values = values.cat.remove_unused_categories()
+            local_codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+        else:
+            local_codes, uniques = pd.factorize(values.astype(object))
+        table = self.codes[col]
+        mapping = np.empty(len(uniques) + 1, dtype=np.int32)
+        mapping[-1] = -1
+        for j, val in enumerate(uniques):
+            code = table.get(val)
+            if code is None:
+                code = len(self.categories[col])
+                table[val] = code
+                self.categories[col].append(val)
+            mapping[j] = code
+        return mapping[local_codes]
+
+    def __convert(self, col: str, values: pd.Series) -> np.ndarray:
+        """
+        Convert column of the incoming data to the stored representation
+
+        :param col: column name
+        :param values: values
+        :return: array
+        """
+        if col in self.codes:
+            return self.__encode(col, values)
+
+        values = pd.to_numeric(values, errors='coerce').to_numpy()
+        stored = self.values[col]
+        if np.result_type(stored.dtype, values.dtype) != stored.dtype:
+            # E.g. integer column which received missing values
+            self.values[col] = stored.astype(np.result_type(stored.dtype, values.dtype))
+        return values
+
+    def __reserve(self, n: int):
+        """
+        Make room for n new rows: move stored rows to the beginning of the arrays or double the capacity
+
+        :param n: number of new rows
+        """
+        if self.end + n <= self.capacity:
+            return
+        size = len(self)
+        capacity = self.capacity
+        # Keep at least half of the capacity free, so that rows are moved O(1) times on average
+        while 2 * (size + n) > capacity:
+            capacity *= 2
+        for key in list(self.values) + [None]:
+            arr = self.index if key is None else self.values[key]
+            if capacity == self.capacity:
+                arr[:size] = arr[self.start:self.end]
+            else:
+                new = np.empty(capacity, dtype=arr.dtype)
+                new[:size] = arr[self.start:self.end]
+                arr = new
+            if key is None:
+                self.index = arr
+            else:
+                self.values[key] = arr
+        self.capacity = capacity
+        self.start = 0
+        self.end = size
+
+    def convert(self, df: pd.DataFrame) -> tuple[dict[str, np.ndarray], np.ndarray]:
+        """
+        Convert data frame to the stored representation
+
+        :param df: data
+        :return: dict with column arrays, index
+        """
+        if self.columns is None:
+            self.__init_columns(df)
+        assert set(df.columns) == set(self.columns)
+        arrays = {col: self.__convert(col, df[col]) for col in self.columns}
+        return arrays, df.index.to_numpy()
+
+    def append(self, arrays: dict[str, np.ndarray], index: np.ndarray):
+        """
+        Append converted rows
+
+        :param arrays: dict with column arrays
+        :param index: index of rows
+        """
+        n = index.shape[0]
+        self.__reserve(n)
+        for col in self.columns:
+            self.values[col][self.end:self.end + n] = arrays[col]
+        self.index[self.end:self.end + n] = index
+        self.end += n
+
+    def replace(self, positions: np.ndarray, rows: np.ndarray, arrays: dict[str, np.ndarray], index: np.ndarray):
+        """
+        Overwrite stored rows
+
+        :param positions: positions of stored rows (relative to the first stored row)
+        :param rows: positions of new rows in arrays
+        :param arrays: dict with column arrays
+        :param index: index of new rows
+        """
+        positions = positions + self.start
+        for col in self.columns:
+            self.values[col][positions] = arrays[col][rows]
+        self.index[positions] = index[rows]
+
+    def discard(self, n: int):
+        """
+        Discard n oldest rows
+
+        :param n: number of rows
+        """
+        self.start += min(n, len(self))
+
+    def get(self, columns: list[str]) -> pd.DataFrame:
+        """
+        Get stored rows. Non-categorical columns are views of the buffer (no copy),
+        so they are valid only until the next change of the buffer. Categorical columns are pandas categorical
+
+        :param columns: columns to return
+        :return: data
+        """
+        data = {}
+        for col in columns:
+            values = self.values[col][self.start:self.end]
+            if col in self.codes:
+                values = pd.Categorical.from_codes(values, categories=pd.Index(self.categories[col], dtype=object))
+            data[col] = values
+        index = pd.Index(self.index[self.start:self.end])
+        return pd.DataFrame(data, index=index, copy=False)
+
+    def arrays(self, columns: list[str]) -> tuple[dict[str, np.ndarray], dict[str, list], np.ndarray]:
+        """
+        Get stored rows without decoding. Arrays are views of the buffer (no copy),
+        so they are valid only until the next change of the buffer
+
+        :param columns: columns to return
+        :return: dict with column arrays (codes for categorical columns, -1 for missing values),
+            dict with category tables of categorical columns, index
+        """
+        arrays = {col: self.values[col][self.start:self.end] for col in columns}
+        tables = {col: self.categories[col] for col in columns if col in self.codes}
+        return arrays, tables, self.index[self.start:self.end]
+
+    def __getstate__(self) -> dict:
+        # Do not pickle unused capacity
+        state = self.__dict__.copy()
+        if self.columns is not None:
+            state['values'] = {col: arr[self.start:self.end].copy() for col, arr in self.values.items()}
+            state['index'] = self.index[self.start:self.end].copy()
+            state['capacity'] = max(len(self), 1)
+            state['start'] = 0
+            state['end'] = len(self)
+        return state
+
 
 class DataCollector:
-    def __init__(self, x: pd.DataFrame = None, y: pd.DataFrame = None):
+    def __init__(self, x: pd.DataFrame = None, y: pd.DataFrame = None, max_size: int = None, policy='window',
+                 seed=0):
         """
         DataCollector aggregates received data
 
         :param x: x
         :param y: y
+        :param max_size: maximum number of stored rows (None for no limit)
+        :param policy: which rows to keep when max_size is exceeded:
+            'window' for the latest rows;
+            'reservoir' for a uniform random sample of all received rows
+        :param seed: random seed for 'reservoir' policy
         """
-        self.x = x
-        self.y = y
+        assert policy in ['window', 'reservoir']
+
+        self.max_size = max_size
+        self.policy = policy
+        self.rng = np.random.default_rng(seed)
+        self.buffer = ColumnBuffer()
+        self.x_cols = None
+        self.y_cols = None
+        self.n_seen = 0  # Number of received rows
+
+        if x is not None:
+            self.add(x, y)
+
+    def __len__(self) -> int:
+        return len(self.buffer)
 
     def add(self, x: pd.DataFrame, y: pd.DataFrame):
         """
@@ -19,12 +236,37 @@ class DataCollector:
         :param x: x
         :param y: y
         """
-        if self.x is None:
-            self.x = x
-            self.y = y
+        if self.x_cols is None:
+            self.x_cols = x.columns.tolist()
+            self.y_cols = y.columns.tolist()
+        arrays, index = self.buffer.convert(pd.concat([x, y], axis=1))
+        n = index.shape[0]
+
+        if self.max_size is None or self.policy == 'window':
+            self.buffer.append(arrays, index)
+            if self.max_size is not None and len(self.buffer) > self.max_size:
+                self.buffer.discard(len(self.buffer) - self.max_size)
         else:
-            self.x = pd.concat([self.x, x], axis=0)
-            self.y = pd.concat([self.y, y], axis=0)
+            # Reservoir sampling: fill the reservoir, then replace random rows
+            n_fill = max(min(self.max_size - len(self.buffer), n), 0)
+            if n_fill:
+                self.buffer.append({col: arr[:n_fill] for col, arr in arrays.items()}, index[:n_fill])
+            rows = np.arange(n_fill, n)
+            slots = self.rng.integers(0, self.n_seen + rows + 1)
+            accepted = slots < self.max_size
+            rows, slots = rows[accepted], slots[accepted]
+            # If several rows hit the same slot, the latest one wins
+            slots, last = np.unique(slots[::-1], return_index=True)
+            rows = rows[::-1][last]
+            self.buffer.replace(slots, rows, arrays, index)
+
+        self.n_seen += n
+
+    def __setstate__(self, state: dict):
+        if 'buffer' not in state:  # State saved by an older version contains concatenated frames
+            self.__init__(state['x'], state['y'])
+        else:
+            self.__dict__.update(state)
 
     def get(self) -> tuple[pd.DataFrame, pd.DataFrame]:
         """
@@ -32,4 +274,18 @@ class DataCollector:
 
         :return: data (x, y)
         """
-        return self.x, self.y
+        if self.x_cols is None:
+            return None, None
+        return self.buffer.get(self.x_cols), self.buffer.get(self.y_cols)
+
+    def get_encoded(self) -> tuple[dict[str, np.ndarray], dict[str, list], np.ndarray]:
+        """
+        Get stored data as it is kept: categorical values are codes of category tables which only grow
+        (a new category gets the next code), so values of earlier batches are encoded once
+
+        :return: dict with column arrays of x and y (codes for categorical columns, -1 for missing values),
+            dict with category tables of categorical columns, index
+        """
+        if self.x_cols is None:
+            return None, None, None
+        return self.buffer.arrays(self.x_cols + self.y_cols)
@@ -1,46 +1,350 @@
+import io
+import os
+import typing
+import numpy as np
 import pandas as pd
 
 from src.utils import read, save
+from src.schema import Schema
+from src.column_cache import ColumnCache
+from src.instrumentation import metrics
 
 
 class DataProvider:
-    def __init__(self, path_to_raw_data: str, time_stamp: str, path_to_save: str):
+    WINDOWS = ['D', 'W', 'M']  # Supported replay granularities: day, week, month
+
+    def __init__(self, path_to_raw_data: str, time_stamp: str, path_to_save: str, stream=False, chunk_size=10000,
+                 schema: Schema = None, autosave=True, cache: ColumnCache = None):
         """
-        DataProvider emulates a streaming data source
+        DataProvider emulates a streaming data source. Data is converted to compact types of the schema
 
         :param path_to_raw_data: path to data (CSV-file)
         :param time_stamp: name of column with time stamps
         :param path_to_save: path to file with DataProvider state
+        :param stream: if True, read the file in chunks instead of loading it entirely into memory
+        :param chunk_size: number of rows parsed at once in streaming mode
+        :param schema: column types (inferred from the first rows of the file if empty)
+        :param autosave: if False, position is saved only by commit (e.g. when batches are read ahead of processing)
+        :param cache: columnar cache of the file (built with the same schema); if given, rows are read from the cache
+            instead of being parsed (in-memory mode does not load the file: only the time stamp column is read
+            to build the time stamp index)
         """
-        self.data = pd.read_csv(path_to_raw_data)
+        self.path_to_raw_data = path_to_raw_data
+        self.autosave = autosave
         self.time_stamp = time_stamp
         self.path_to_save = path_to_save
-        self.i = 0
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.i = 0  # Number of rows handed out (index of the next row in batch mode)
+        self.offset = None  # Byte offset of the next row (streaming mode only)
+        self.t = 0  # Position in time-ordered data (see get_window_data)
+        self.path_to_index = os.path.splitext(path_to_save)[0] + '_index.pkl'
+        self.index = None
+        self.schema = Schema() if schema is None else schema
+        self.cache = cache
+        self.dates = pd.Series([], dtype='datetime64[ns]')  # Parsed categories of the time stamp column
+
+        if self.cache is not None:
+            # Building the cache extends the schema with types of the whole file
+            self.cache.open()
+        elif not self.schema.dtypes:
+            self.schema.infer(pd.read_csv(path_to_raw_data, nrows=chunk_size))
+        if self.stream:
+            self.data = None
+            self.__init_stream()
+        elif self.cache is not None:
+            # Rows are read from memory-mapped columns when they are handed out
+            self.data = None
+        else:
+            self.data = self.schema.apply(pd.read_csv(path_to_raw_data, dtype=self.schema.csv_dtypes()))
 
         self.__load_state()
 
+    def __init_stream(self):
+        """
+        Read the header
+        """
+        self.chunk_offsets = []  # Byte offset of the end of each row in self.chunk
+        self.chunk_keys = {}  # Window length -> window keys of rows in self.chunk (time stamps are parsed once)
+        if self.cache is not None:
+            # Rows are read from the cache by their numbers, so byte offsets are not used
+            self.chunk = self.schema.cast(self.cache.read(stop=0))
+            return
+
+        with open(self.path_to_raw_data, 'rb') as f:
+            self.header = self.__read_record(f)
+            self.offset = f.tell()
+        # Keep categorical columns categorical even if a chunk contains only missing values
+        self.dtypes = self.schema.csv_dtypes()
+
+        # Parsed rows which have not been handed out yet
+        self.chunk = self.schema.cast(pd.read_csv(io.BytesIO(self.header)))
+
+    @staticmethod
+    def __read_record(f: typing.BinaryIO) -> bytes:
+        """
+        Read one CSV record. A quoted field may contain line breaks, so lines are joined until quotes are balanced
+        (escaped quotes are doubled and do not change the balance)
+
+        :param f: file opened in binary mode
+        :return: record with its line break (empty at the end of file)
+        """
+        record = f.readline()
+        while record.count(b'"') % 2 == 1:
+            line = f.readline()
+            if not line:
+                break
+            record += line
+        return record
+
     def __load_state(self):
         try:
-            self.i = read(self.path_to_save)
+            state = read(self.path_to_save)
         except FileNotFoundError:
-            pass
+            return
+
+        if isinstance(state, dict):
+            self.i = state['i']
+            self.t = state.get('t', 0)
+            offset = state.get('offset')
+        else:  # State saved by an older version contains only the row index
+            self.i = state
+            offset = None
+
+        if self.stream and self.cache is None:
+            if offset is None:
+                offset = self.__skip_rows(self.i)
+            self.offset = offset
 
     def __save_state(self):
-        save(self.path_to_save, self.i)
+        if self.autosave:
+            self.commit()
 
-    def get_day_data(self) -> pd.DataFrame:
+    def state(self) -> dict[str, typing.Any]:
         """
-        Generate one-day data
+        Get position in data
+
+        :return: state
+        """
+        return {'i': self.i, 'offset': self.offset, 't': self.t}
 
+    def commit(self, state: dict[str, typing.Any] = None):
+        """
+        Save position in data
+
+        :param state: state returned by state() earlier (the current state by default)
+        """
+        save(self.path_to_save, self.state() if state is None else state)
+
+    def __parse_time_stamps(self, values: pd.Series) -> tuple[np.ndarray, pd.Series]:
+        """
+        Parse time stamps. Categories of the time stamp column are parsed once: the dictionary of the schema only grows,
+        so dates of known categories are reused
+
+        :param values: time stamps
+        :return: (codes of rows, dates of codes); the last date is NaT for code -1 of missing time stamps
+        """
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = values.cat.categories
+            if self.dates.shape[0] < len(categories):
+                new = pd.to_datetime(pd.Series(categories[self.dates.shape[0]:]), dayfirst=True, errors='coerce')
+                self.dates = pd.concat([self.dates, new], ignore_index=True)
+            codes = values.cat.codes.to_numpy()
+            dates = self.dates.iloc[:len(categories)]
+        else:
+            uniques, codes = np.unique(values.astype(str).to_numpy(), return_inverse=True)
+            dates = pd.to_datetime(pd.Series(uniques), dayfirst=True, errors='coerce')
+        return codes, pd.concat([dates, pd.Series([pd.NaT], dtype=dates.dtype)], ignore_index=True)
+
+    def __build_index(self) -> dict:
+        """
+        Sort rows by time stamp and find boundaries of days, weeks and months
+
+        :return: dict with row order and window start positions for each frequency
+        """
+        if self.data is not None:
+            time_stamps = self.data[self.time_stamp]
+        else:
+            time_stamps = self.cache.read([self.time_stamp])[self.time_stamp]
+        inverse, dates = self.__parse_time_stamps(time_stamps)
+        row_dates = dates.to_numpy()[inverse]
+        order = np.argsort(row_dates, kind='stable')
+
+        starts = {}
+        for freq in self.WINDOWS:
+            # Period ordinals of rows in time order (rows with unparsed time stamps share one window at the end)
+            keys = dates.dt.to_period(freq).array.asi8[inverse][order]
+            starts[freq] = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+
+        return {'order': order, 'starts': starts}
+
+    def __load_index(self):
+        """
+        Load time stamp index from cache or build it
+        """
+        stat = os.stat(self.path_to_raw_data)
+        source = (os.path.abspath(self.path_to_raw_data), stat.st_size, stat.st_mtime_ns, self.time_stamp)
+        try:
+            index = read(self.path_to_index)
+            if index['source'] == source:
+                self.index = index
+                return
+        except FileNotFoundError:
+            pass
+
+        self.index = self.__build_index()
+        self.index['source'] = source
+        save(self.path_to_index, self.index)
+
+    def __skip_rows(self, n: int) -> int:
+        """
+        Find byte offset of the row with the given index
+
+        :param n: index of the row
+        :return: byte offset
+        """
+        with open(self.path_to_raw_data, 'rb') as f:
+            self.__read_record(f)
+            for _ in range(n):
+                if not self.__read_record(f):
+                    break
+            return f.tell()
+
+    def __read_chunk(self):
+        """
+        Parse the next chunk of rows starting from the current byte offset (or read it from the cache)
+        """
+        if self.cache is not None:
+            self.chunk = self.schema.apply(self.cache.read(start=self.i, stop=self.i + self.chunk_size))
+            self.chunk_offsets = [None] * self.chunk.shape[0]
+            self.chunk_keys = {}
+            return
+
+        lines = []
+        offsets = []
+        with open(self.path_to_raw_data, 'rb') as f:
+            f.seek(self.offset)
+            for _ in range(self.chunk_size):
+                line = self.__read_record(f)
+                if not line:
+                    break
+                lines.append(line)
+                offsets.append(f.tell())
+        if not lines:
+            self.chunk = self.chunk.iloc[:0]
+            self.chunk_offsets = []
+            self.chunk_keys = {}
+            return
+
+        raw = io.BytesIO(self.header + b''.join(lines))
+        chunk = self.schema.apply(pd.read_csv(raw, dtype=self.dtypes))
+        chunk.index = pd.RangeIndex(self.i, self.i + chunk.shape[0])
+        self.chunk = chunk
+        self.chunk_offsets = offsets
+        self.chunk_keys = {}
+
+    def __take(self, n: int) -> pd.DataFrame:
+        """
+        Hand out first n rows of the current chunk and move the position
+
+        :param n: number of rows
+        :return: data
+        """
+        rows = self.chunk.iloc[:n]
+        if not rows.empty:
+            self.offset = self.chunk_offsets[rows.shape[0] - 1]
+            self.i += rows.shape[0]
+            self.chunk = self.chunk.iloc[rows.shape[0]:]
+            self.chunk_offsets = self.chunk_offsets[rows.shape[0]:]
+            self.chunk_keys = {freq: keys[rows.shape[0]:] for freq, keys in self.chunk_keys.items()}
+        return rows
+
+    def __stream_batch(self, batch_size: int) -> pd.DataFrame:
+        parts = []
+        left = batch_size
+        while left > 0:
+            if self.chunk.empty:
+                self.__read_chunk()
+                if self.chunk.empty:
+                    break
+            part = self.__take(left)
+            parts.append(part)
+            left -= part.shape[0]
+        if not parts:
+            return self.chunk.iloc[:0]
+        # Parts of earlier chunks have shorter dictionaries of categories
+        return pd.concat([self.schema.cast(part) for part in parts], axis=0)
+
+    def __stream_window(self, freq: str) -> pd.DataFrame:
+        """
+        Hand out the run of consecutive rows belonging to the same time window
+
+        :param freq: window length
+        :return: data
+        """
+        parts = []
+        window = None
+        while True:
+            if self.chunk.empty:
+                self.__read_chunk()
+                if self.chunk.empty:
+                    break
+            keys = self.chunk_keys.get(freq)
+            if keys is None:
+                inverse, dates = self.__parse_time_stamps(self.chunk[self.time_stamp])
+                keys = self.chunk_keys[freq] = dates.dt.to_period(freq).array.asi8[inverse]
+            if window is None:
+                window = keys[0]
+            same_window = keys == window
+            n = same_window.shape[0] if same_window.all() else same_window.argmin()
+            parts.append(self.__take(n))
+            if not self.chunk.empty:
+                break
+        if not parts:
+            return self.chunk.iloc[:0]
+        # Parts of earlier chunks have shorter dictionaries of categories
+        return pd.concat([self.schema.cast(part) for part in parts], axis=0)
+
+    def get_window_data(self, freq='D') -> pd.DataFrame:
+        """
+        Generate data of one time window (day, week or month).
+        In-memory mode uses a cached time stamp index, so rows of a window need not be contiguous in the file.
+        Streaming mode expects the file to be sorted by time stamps
+
+        :param freq: window length: 'D' for day, 'W' for week, 'M' for month
         :return: data
         """
-        date = self.data.loc[self.i, self.time_stamp]
-        day_data = self.data[self.data[self.time_stamp] == date]
-        self.i += day_data.shape[0]
+        assert freq in self.WINDOWS
 
-        self.__save_state()
+        with metrics.timer('read_batch'):
+            if self.stream:
+                data = self.__stream_window(freq)
+            else:
+                if self.index is None:
+                    self.__load_index()
+                order = self.index['order']
+                starts = self.index['starts'][freq]
+                k = np.searchsorted(starts, self.t, side='right')
+                end = starts[k] if k < starts.shape[0] else order.shape[0]
+                if self.data is not None:
+                    data = self.data.iloc[order[self.t:end]]
+                else:
+                    data = self.schema.apply(self.cache.take(order[self.t:end]))
+                # Rows are handed out in time order, so both positions count rows handed out
+                self.t = self.i = int(end)
 
-        return day_data
+            self.__save_state()
+        metrics.count('rows_read', data.shape[0])
+
+        return data
+
+    def get_day_data(self) -> pd.DataFrame:
+        """
+        Generate one-day data
+
+        :return: data
+        """
+        return self.get_window_data('D')
 
     def get_batch(self, batch_size=50) -> pd.DataFrame:
         """
@@ -49,11 +353,19 @@ class DataProvider:
         :param batch_size: Amount of data
         :return: data
         """
-        start = self.i
-        end = self.i + batch_size - 1
-        batch = self.data.loc[start:end]
-        self.i += batch_size
+        with metrics.timer('read_batch'):
+            if self.stream:
+                batch = self.__stream_batch(batch_size)
+            else:
+                start = self.i
+                end = self.i + batch_size - 1
+                if self.data is not None:
+                    batch = self.data.loc[start:end]
+                else:
+                    batch = self.schema.apply(self.cache.read(start=start, stop=end + 1))
+                self.i += batch_size
 
-        self.__save_state()
+            self.__save_state()
+        metrics.count('rows_read', batch.shape[0])
 
         return batch
@@ -1,8 +1,19 @@
+from __future__ import annotations
+
+import typing
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import OneHotEncoder
 
-from src.utils import data_to_xy
+from src.schema import is_categorical, categorical_columns, get_indexer
+from src.sketches import QuantileSketch
+from src.instrumentation import metrics
+
+# scipy is imported only when a CSR matrix is built, so that inference does not load it
+if typing.TYPE_CHECKING:
+    from scipy import sparse
+
+# Formats of processed features: data frame, float32 C-contiguous array or float32 CSR matrix
+OUTPUTS = ['frame', 'dense', 'sparse']
 
 
 class DataTransformer:
@@ -24,8 +35,99 @@ class DataTransformer:
         self.na_method = na_method
         self.ctg_method = ctg_method
 
-        self.ohe = None
-        self.ohe_categories = None
+        self.fill_values = None  # Values replacing missing values of each column (learned from training data)
+        self.ohe_categories = None  # Categories of each categorical column in order of encoded columns
+        self.ctg_cols = None  # Categorical columns seen in training data
+        self.encoded_cols = None  # Names of encoded columns
+        self.ctg_index = None  # Hash-based lookup of category codes (one index per categorical column)
+        self.ctg_offsets = None  # Position of the first encoded column of each categorical column
+        self.dropped_by_col = {}  # Number of rows with unknown categories in each column of the last processed data
+        self.feature_names = None  # Names of columns of processed features (columns of matrices)
+        self.index = None  # Index of rows of the last processed features (rows of matrices)
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        if 'encoded_cols' not in state:  # State saved by an older version keeps categories in a fitted encoder
+            ohe = self.__dict__.pop('ohe', None)
+            self.ctg_cols = None if ohe is None else ohe.feature_names_in_.tolist()
+            self.dropped_by_col = state.get('dropped_by_col', {})
+            self.encoded_cols = None
+            if ohe is not None:
+                self.__init_ctg_index()
+        if 'fill_values' not in state:  # Fill values are not saved by older versions
+            self.fill_values = None
+        if 'feature_names' not in state:
+            self.feature_names = None
+            self.index = None
+
+    def __init_ctg_index(self):
+        """
+        Build category lookup and names of encoded columns from the categories
+        """
+        self.ctg_index = [pd.Index(categories) for categories in self.ohe_categories]
+        sizes = [len(categories) for categories in self.ohe_categories]
+        self.ctg_offsets = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int64)
+        self.encoded_cols = [f'{col}_{category}'
+                             for col, categories in zip(self.ctg_cols, self.ohe_categories) for category in categories]
+
+    def __encode_ctg(self, data: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Look up positions of encoded categories. Rows containing unknown categories are removed
+
+        :param data: data
+        :return: (positions of encoded columns of known rows (rows x categorical columns), mask of known rows)
+        """
+        # Look up codes of categories (-1 for unknown categories)
+        codes = np.empty((data.shape[0], len(self.ctg_cols)), dtype=np.int64)
+        for j, col in enumerate(self.ctg_cols):
+            codes[:, j] = get_indexer(self.ctg_index[j], data[col])
+        unknown = codes < 0
+        self.dropped_by_col = dict(zip(self.ctg_cols, unknown.sum(axis=0).tolist()))
+        # Drop rows containing unknown categories
+        known = ~unknown.any(axis=1)
+        return codes[known] + self.ctg_offsets, known
+
+    def __assemble(self, noncategorical: dict[str, np.ndarray], positions: np.ndarray, index: pd.Index,
+                   output: str) -> typing.Union[pd.DataFrame, np.ndarray, sparse.csr_matrix]:
+        """
+        Concatenate non-categorical and one-hot encoded categorical features
+
+        :param noncategorical: arrays of non-categorical features
+        :param positions: positions of encoded columns which are set to 1 (rows x categorical columns)
+        :param index: index of rows
+        :param output: format of features (see OUTPUTS)
+        :return: features
+        """
+        n, n_num = index.shape[0], len(noncategorical)
+        self.index = index
+        if output == 'frame':
+            encoded_ctg = np.zeros((n, len(self.encoded_cols)), dtype=np.uint8)
+            encoded_ctg[np.arange(n)[:, None], positions] = 1
+            return pd.concat([pd.DataFrame(noncategorical, index=index),
+                              pd.DataFrame(encoded_ctg, columns=self.encoded_cols, index=index)], axis=1)
+
+        # Matrices are written at once, without intermediate frames
+        shape = (n, n_num + len(self.encoded_cols))
+        if output == 'dense':
+            matrix = np.zeros(shape, dtype=np.float32)
+            for j, values in enumerate(noncategorical.values()):
+                matrix[:, j] = values
+            matrix[np.arange(n)[:, None], n_num + positions] = 1
+            return matrix
+        from scipy import sparse
+
+        # Each row has the same number of stored values: non-categorical features and one 1 per categorical column
+        k = n_num + positions.shape[1]
+        values = np.ones((n, k), dtype=np.float32)
+        columns = np.empty((n, k), dtype=np.int32)
+        for j, arr in enumerate(noncategorical.values()):
+            values[:, j] = arr
+        columns[:, :n_num] = np.arange(n_num)
+        columns[:, n_num:] = n_num + positions
+        matrix = sparse.csr_matrix((values.ravel(), columns.ravel(), np.arange(n + 1, dtype=np.int64) * k),
+                                   shape=shape)
+        matrix.eliminate_zeros()
+        return matrix
 
     def __process_timestamps(self, data: pd.DataFrame) -> pd.DataFrame:
         data = data.drop(self.timestamps, axis=1)
@@ -40,110 +142,238 @@ class DataTransformer:
         """
         if self.na_method == 'drop':
             data = data.dropna()
-        elif self.na_method == 'median-mode':
-            categorical_cols = data.dtypes[data.dtypes == 'object'].index.tolist()
-            noncategorical_cols = data.dtypes[data.dtypes != 'object'].index.tolist()
+        elif self.na_method == 'median-mode' and self.fill_values is None:
+            # Transformer fitted by an older version has no fill values, so statistics of the data are used
+            categorical_cols = categorical_columns(data)
+            noncategorical_cols = [col for col in data.columns if col not in categorical_cols]
             modes = data[categorical_cols].mode(axis=0).to_numpy()[0].tolist()
             medians = data[noncategorical_cols].median().tolist()
             placeholders = dict(zip(categorical_cols + noncategorical_cols, modes + medians))
             data = data.fillna(value=placeholders)
+        elif self.na_method == 'median-mode':
+            placeholders = {col: value for col, value in self.fill_values.items()
+                            if col in data.columns and not pd.isna(value)}
+            for col, value in placeholders.items():
+                # A category of training data may be missing among categories of the data type
+                if isinstance(data[col].dtype, pd.CategoricalDtype) and value not in data[col].cat.categories:
+                    data[col] = data[col].cat.add_categories([value])
+            data = data.fillna(value=placeholders)
 
         return data
 
-    def __process_ctg(self, data: pd.DataFrame) -> pd.DataFrame:
+    def __fill_na(self, columns: dict[str, np.ndarray], tables: dict[str, typing.Sequence]) -> np.ndarray:
         """
-        Process categorical features
+        Process missing values of encoded data. For 'median-mode' method, medians and modes of the data
+        are saved to fill missing values of data processed by prepare_pred
 
-        :param data: data
-        :return: processed data
+        :param columns: column arrays (categorical columns are codes, -1 for missing values); filled in place
+        :param tables: categories of each categorical column
+        :return: mask of kept rows (None for all rows)
         """
-        if self.ctg_method == 'ohe':
-            # Encode categorical features
-            categorical_cols = data.dtypes[data.dtypes == 'object'].index.tolist()
-            self.ohe = OneHotEncoder()
-            encoded_ctg = self.ohe.fit_transform(data[categorical_cols])
-            # Save categories
-            self.ohe_categories = self.ohe.categories_
-            # Concatenate non-categorical and encoded categorical features
-            noncategorical = data.drop(categorical_cols, axis=1)
-            encoded_ctg = pd.DataFrame(encoded_ctg.toarray(), columns=self.ohe.get_feature_names_out(),
-                                       dtype=int, index=noncategorical.index)
-            data = pd.concat([noncategorical, encoded_ctg], axis=1)
+        if self.na_method == 'drop':
+            keep = None
+            for col, values in columns.items():
+                missing = values < 0 if col in tables else (np.isnan(values) if values.dtype.kind == 'f' else None)
+                if missing is not None and missing.any():
+                    keep = ~missing if keep is None else keep & ~missing
+            return keep
 
-        return data
+        self.fill_values = {}
+        for col, values in columns.items():
+            if col in tables:
+                missing = values < 0
+                # The first most frequent code, as pandas mode of categorical data gives
+                counts = np.bincount(values[~missing], minlength=1)
+                code = int(counts.argmax()) if counts.any() else -1
+                self.fill_values[col] = tables[col][code] if code >= 0 else np.nan
+                if code >= 0 and missing.any():
+                    columns[col] = np.where(missing, code, values).astype(np.int32)
+            elif values.dtype.kind in 'fiub':
+                missing = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(values.shape[0], dtype=bool)
+                median = float(np.median(values[~missing].astype(np.float64))) if not missing.all() else np.nan
+                self.fill_values[col] = median
+                if missing.any() and not np.isnan(median):
+                    columns[col] = np.where(missing, values.dtype.type(median), values)
+        return None
 
-    def __rm_unknown_ctg(self, data: pd.DataFrame) -> pd.DataFrame:
+    def __process_ctg(self, codes: dict[str, np.ndarray], tables: dict[str, typing.Sequence]) -> np.ndarray:
         """
-        Remove rows containing unknown categorical values from the data
+        Process categorical features: extend categories with the new ones and look up positions of encoded columns.
+        Categories already known keep their encoded columns, new categories get columns appended after them
 
-        :param data: data
-        :return: processed data
+        :param codes: codes of categorical columns (in tables)
+        :param tables: categories of each categorical column
+        :return: positions of encoded columns (rows x categorical columns)
         """
-        # Get columns with categorical values
-        categorical_cols = data.dtypes[data.dtypes == 'object'].index.tolist()
-        categorical = data[categorical_cols]
-        # Search unknown categories in columns
-        unknown = []
-        for i in range(categorical.shape[1]):
-            col_name = categorical_cols[i]
-            col = data[col_name]
-            unknown.append(col.apply(lambda val: val not in self.ohe_categories[i]))
-        unknown = pd.concat(unknown, axis=1).any(axis=1)
-        # Get rows containing unknown categories
-        rows_with_unknown = np.where(unknown, unknown.index, -1)
-        rows_with_unknown = set(rows_with_unknown)
-        rows_with_unknown.discard(-1)
-        # Drop these rows
-        data = data.drop(index=list(rows_with_unknown), axis=0)
-        if data.empty:
-            return data
-        # Encode categorical features
-        encoded_ctg = self.ohe.transform(data[categorical_cols])
-        # Concatenate non-categorical and encoded categorical features
-        noncategorical = data.drop(categorical_cols, axis=1)
-        encoded_ctg = pd.DataFrame(encoded_ctg.toarray(), columns=self.ohe.get_feature_names_out(),
-                                   dtype=int, index=noncategorical.index)
-        data = pd.concat([noncategorical, encoded_ctg], axis=1)
+        n = len(next(iter(codes.values()))) if codes else 0
+        if self.ctg_method == 'ohe':
+            known = {} if self.ctg_cols is None else dict(zip(self.ctg_cols, self.ohe_categories))
+            self.ctg_cols = list(codes)
+            self.ohe_categories = []
+            positions = []
+            for col in self.ctg_cols:
+                categories = list(known.get(col, []))
+                # Only categories present in the data are looked up, once per category rather than once per row.
+                # Missing values left by the mode fill of an empty column take slot 0, as the encoder did
+                table = pd.Index([np.nan], dtype=object).append(pd.Index(tables[col], dtype=object))
+                present = np.flatnonzero(np.bincount(codes[col] + 1, minlength=len(table)))
+                lookup = np.full(len(table), -1, dtype=np.int64)
+                lookup[present] = pd.Index(categories, dtype=object).get_indexer(table.take(present))
+                for i in present[lookup[present] < 0]:
+                    lookup[i] = len(categories)
+                    categories.append(table[i])
+                self.ohe_categories.append(np.array(categories, dtype=object))
+                positions.append(lookup)
+            self.__init_ctg_index()
 
-        return data
+            encoded_positions = np.empty((n, len(self.ctg_cols)), dtype=np.int64)
+            for j, (col, lookup) in enumerate(zip(self.ctg_cols, positions)):
+                encoded_positions[:, j] = self.ctg_offsets[j] + lookup[codes[col] + 1]
+            self.dropped_by_col = dict.fromkeys(self.ctg_cols, 0)
+
+            return encoded_positions
 
-    def prepare_train(self, x: pd.DataFrame, y: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    def prepare_train(self, x: pd.DataFrame, y: pd.DataFrame,
+                      output='frame') -> tuple[typing.Union[pd.DataFrame, np.ndarray, sparse.csr_matrix], pd.DataFrame]:
         """
         Process data to prepare it for training
 
         :param x: features
         :param y: target
+        :param output: format of processed features: 'frame' for data frame; 'dense' for float32 array;
+            'sparse' for float32 CSR matrix. Columns of matrices are named by feature_names, rows by index
+        :return: processed (x, y)
+        """
+        columns = {col: values.to_numpy() for col, values in y.items()}
+        tables = {}
+        for col, values in x.items():
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                columns[col], tables[col] = values.cat.codes.to_numpy(), values.cat.categories
+            elif is_categorical(values):
+                columns[col], tables[col] = pd.factorize(values)
+            else:
+                columns[col] = values.to_numpy()
+        return self.prepare_train_encoded(columns, tables, x.index.to_numpy(), x.columns.tolist(), y.columns.tolist(),
+                                          output)
+
+    def prepare_train_encoded(self, columns: dict[str, np.ndarray], tables: dict[str, typing.Sequence],
+                              index: np.ndarray, x_cols: list[str], y_cols: list[str],
+                              output='frame') -> tuple[typing.Union[pd.DataFrame, np.ndarray, sparse.csr_matrix],
+                                                       pd.DataFrame]:
+        """
+        Process data to prepare it for training. Data is given as column arrays where categorical values
+        are already encoded by codes of category tables (e.g. by DataCollector), so values are not looked up again
+        and encoded features are built from the codes directly
+
+        :param columns: column arrays; categorical columns are codes (-1 for missing values)
+        :param tables: categories of each categorical column
+        :param index: index of rows
+        :param x_cols: feature columns
+        :param y_cols: target columns
+        :param output: format of processed features (see prepare_train)
         :return: processed (x, y)
         """
-        data = pd.concat((x, y), axis=1)
+        assert output in OUTPUTS
 
-        # Process timestamps column
-        data = self.__process_timestamps(data)
-        # Process missing values
-        data = self.__process_na(data)
-        # Process categorical features
-        data = self.__process_ctg(data)
+        with metrics.timer('transform'):
+            n_rows = index.shape[0]
+            # Process timestamps column
+            x_cols = [col for col in x_cols if col != self.timestamps]
+            columns = {col: columns[col] for col in x_cols + y_cols}
+            ctg_cols = [col for col in x_cols if col in tables]
+            # Process missing values
+            keep = self.__fill_na(columns, {col: tables[col] for col in columns if col in tables})
+            if keep is not None:
+                columns = {col: values[keep] for col, values in columns.items()}
+                index = index[keep]
+            # Process categorical features
+            positions = self.__process_ctg({col: columns[col] for col in ctg_cols}, tables)
 
-        x, y = data_to_xy(data, y.columns)
+            index = pd.Index(index)
+            noncategorical = {col: columns[col] for col in x_cols if col not in tables}
+            self.feature_names = list(noncategorical) + self.encoded_cols
+            x = self.__assemble(noncategorical, positions, index, output)
+            y = pd.DataFrame({col: pd.Categorical.from_codes(columns[col], categories=tables[col])
+                              if col in tables else columns[col] for col in y_cols}, index=index)
+        metrics.count('rows_transformed', n_rows)
+        metrics.count('rows_removed', n_rows - x.shape[0])
         return x, y
 
-    def prepare_pred(self, x: pd.DataFrame, y: pd.DataFrame = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    def fit_stream(self, batches: typing.Iterable[tuple[pd.DataFrame, pd.DataFrame]], sketch_size=1000):
+        """
+        Learn categories and fill values from data given batch by batch (e.g. data which does not fit into memory),
+        so that prepare_pred prepares training data of any batch the same way.
+        Categories and modes are counted exactly, medians are estimated by quantile sketches
+
+        :param batches: iterator over (x, y)
+        :param sketch_size: number of centroids of quantile sketches
+        """
+        counts = {}  # Categorical column -> {category: count} in order of appearance
+        sketches = {}  # Non-categorical column -> sketch
+        x_cols = None
+        for x, y in batches:
+            data = self.__process_timestamps(pd.concat((x, y), axis=1))
+            if x_cols is None:
+                x_cols = [col for col in data.columns if col not in y.columns]
+            for col, values in data.items():
+                if col in x_cols and is_categorical(values):
+                    present = values.value_counts(sort=False)
+                    col_counts = counts.setdefault(col, {})
+                    for category, n in present[present > 0].items():
+                        col_counts[category] = col_counts.get(category, 0) + n
+                elif values.dtype.kind in 'fiub':
+                    sketches.setdefault(col, QuantileSketch(sketch_size)).update(values.to_numpy())
+        if x_cols is None:
+            return
+
+        # Categories already known keep their encoded columns, new categories get columns appended after them
+        known = {} if self.ctg_cols is None else dict(zip(self.ctg_cols, self.ohe_categories))
+        self.ctg_cols = list(counts)
+        self.ohe_categories = []
+        for col in self.ctg_cols:
+            categories = list(known.get(col, []))
+            seen = set(categories)
+            categories += [category for category in counts[col] if category not in seen]
+            self.ohe_categories.append(np.array(categories, dtype=object))
+        self.__init_ctg_index()
+
+        self.fill_values = None
+        if self.na_method == 'median-mode':
+            self.fill_values = {col: max(col_counts, key=col_counts.get) if col_counts else np.nan
+                                for col, col_counts in counts.items()}
+            self.fill_values.update({col: float(sketch.quantile(0.5)) for col, sketch in sketches.items()})
+        self.feature_names = [col for col in x_cols if col not in counts] + self.encoded_cols
+
+    def prepare_pred(self, x: pd.DataFrame, y: pd.DataFrame = None,
+                     output='frame') -> tuple[typing.Union[pd.DataFrame, np.ndarray, sparse.csr_matrix], pd.DataFrame]:
         """
         Process data to prepare it for making prediction
 
         :param x: features
         :param y: target (optional)
+        :param output: format of processed features (see prepare_train)
         :return: processed (x, y)
         """
-        data = x if y is None else pd.concat((x, y), axis=1)
+        assert output in OUTPUTS
 
-        # Process timestamps column
-        data = self.__process_timestamps(data)
-        # Process missing values
-        data = self.__process_na(data)
-        # Process categorical features
-        if self.ctg_method == 'ohe':
-            data = self.__rm_unknown_ctg(data)
+        with metrics.timer('transform'):
+            n_rows = x.shape[0]
+            data = x if y is None else pd.concat((x, y), axis=1)
+
+            # Process timestamps column
+            data = self.__process_timestamps(data)
+            # Process missing values
+            data = self.__process_na(data)
+            # Process categorical features
+            if self.ctg_method == 'ohe':
+                positions, known = self.__encode_ctg(data)
+                data = data[known]
 
-        x, y = (data, None) if y is None else data_to_xy(data, y.columns)
+            y_cols = [] if y is None else y.columns.tolist()
+            noncategorical = {col: data[col].to_numpy() for col in data.columns
+                              if col not in self.ctg_cols and col not in y_cols}
+            x = self.__assemble(noncategorical, positions, data.index, output)
+            y = None if y is None else data[y_cols]
+        metrics.count('rows_transformed', n_rows)
+        metrics.count('rows_removed', n_rows - x.shape[0])
         return x, y
@@ -0,0 +1,187 @@
+import copy
+import typing
+import collections
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from src.utils import read, save
+from src.schema import get_indexer
+from src.data_analyzer import DataAnalyzer
+from src.instrumentation import metrics
+
+
+class DriftDetector:
+    def __init__(self, path_to_save: str = None, window=10, n_bins=10, threshold=0.2, ignore: list[str] = None,
+                 autosave=True):
+        """
+        DriftDetector compares distributions of features in a sliding window of batches with reference distributions.
+        Features are binned: numeric features by quantiles from DataAnalyzer sketches,
+        categorical features by the most frequent values from DataAnalyzer counters.
+        The first window batches form the reference
+
+        :param path_to_save: path to file with DriftDetector state (None for no saving)
+        :param window: number of batches in the sliding window
+        :param n_bins: number of bins per feature (plus one bin for missing values)
+        :param threshold: PSI value above which a feature is considered drifted
+        :param ignore: columns which are not checked (e.g. time stamps)
+        :param autosave: if False, state is saved only by commit (e.g. when batches are checked ahead of training)
+        """
+        self.path_to_save = path_to_save
+        self.autosave = autosave
+        self.window = window
+        self.n_bins = n_bins
+        self.threshold = threshold
+        self.ignore = [] if ignore is None else ignore
+
+        self.num_cols = None
+        self.ctg_cols = None
+        self.edges = None  # Bin edges of numeric features (padded with inf)
+        self.ctg_index = None  # Bins of categorical features (values not in index fall into the last bin)
+        self.reference = None  # Reference counts (features x bins)
+        self.n_reference = 0  # Number of batches in reference
+        self.recent = collections.deque()  # Counts of batches in the window
+        self.recent_sum = None
+
+        self.__load_state()
+
+    def __load_state(self):
+        if self.path_to_save is None:
+            return
+        try:
+            self.__dict__.update(read(self.path_to_save))
+        except FileNotFoundError:
+            pass
+
+    def __save_state(self):
+        if self.autosave:
+            self.commit()
+
+    def state(self) -> dict[str, typing.Any]:
+        """
+        Get a copy of the state (bins and histograms)
+
+        :return: state
+        """
+        state = self.__dict__.copy()
+        del state['path_to_save'], state['autosave']
+        return copy.deepcopy(state)
+
+    def commit(self, state: dict[str, typing.Any] = None):
+        """
+        Save state
+
+        :param state: state returned by state() earlier (the current state by default)
+        """
+        if self.path_to_save is not None:
+            save(self.path_to_save, self.state() if state is None else state)
+
+    def __init_bins(self, analyzer: DataAnalyzer):
+        """
+        Define bins from statistics of data analyzed so far
+
+        :param analyzer: data analyzer
+        """
+        self.num_cols = [col for col in analyzer.noncategorical_cols if col not in self.ignore]
+        self.ctg_cols = [col for col in analyzer.categorical_cols if col not in self.ignore]
+
+        levels = np.linspace(0, 1, self.n_bins + 1)[1:-1]
+        self.edges = np.full((len(self.num_cols), self.n_bins - 1), np.inf)
+        for j, col in enumerate(self.num_cols):
+            edges = np.unique(analyzer.sketches[col].quantile(levels))
+            self.edges[j, :edges.shape[0]] = edges
+        self.ctg_index = [pd.Index([value for value, _ in analyzer.counters[col].top(self.n_bins - 1)])
+                          for col in self.ctg_cols]
+
+        n_features = len(self.num_cols) + len(self.ctg_cols)
+        self.reference = np.zeros((n_features, self.n_bins + 1))
+        self.recent_sum = np.zeros((n_features, self.n_bins + 1))
+
+    def __count(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Build histograms of all features of a batch
+
+        :param df: data
+        :return: counts (features x bins); the last bin counts missing values
+        """
+        n = df.shape[0]
+        bins = np.empty((n, len(self.num_cols) + len(self.ctg_cols)), dtype=np.int64)
+
+        values = df[self.num_cols].to_numpy(dtype=np.float64)
+        bins[:, :len(self.num_cols)] = (values[:, :, None] > self.edges[None, :, :]).sum(axis=2)
+        bins[:, :len(self.num_cols)][np.isnan(values)] = self.n_bins
+
+        for j, col in enumerate(self.ctg_cols):
+            codes = get_indexer(self.ctg_index[j], df[col])
+            codes[codes < 0] = self.n_bins - 1
+            codes[df[col].isna().to_numpy()] = self.n_bins
+            bins[:, len(self.num_cols) + j] = codes
+
+        # Count bins of all features at once
+        flat = bins + np.arange(bins.shape[1]) * (self.n_bins + 1)
+        counts = np.bincount(flat.ravel(), minlength=bins.shape[1] * (self.n_bins + 1))
+        return counts.reshape(bins.shape[1], self.n_bins + 1).astype(np.float64)
+
+    def __scores(self) -> pd.DataFrame:
+        """
+        Compare window histograms with reference histograms
+
+        :return: drift scores of features
+        """
+        eps = 1e-4
+        p = self.reference / self.reference.sum(axis=1, keepdims=True)
+        q = self.recent_sum / self.recent_sum.sum(axis=1, keepdims=True)
+        # Population stability index
+        psi = ((q - p) * np.log((q + eps) / (p + eps))).sum(axis=1)
+        # Kolmogorov-Smirnov statistic on binned distributions
+        ks = np.abs(np.cumsum(p, axis=1) - np.cumsum(q, axis=1)).max(axis=1)
+        # Chi-square test of window counts against reference proportions
+        expected = p * self.recent_sum.sum(axis=1, keepdims=True)
+        nonempty = expected > 0
+        chi2 = np.where(nonempty, (self.recent_sum - expected) ** 2 / np.where(nonempty, expected, 1), 0).sum(axis=1)
+        chi2 += np.where(~nonempty & (self.recent_sum > 0), np.inf, 0).sum(axis=1)
+        dof = np.maximum(nonempty.sum(axis=1) - 1, 1)
+        p_value = stats.chi2.sf(chi2, dof)
+
+        return pd.DataFrame({'psi': psi, 'ks': ks, 'chi2': chi2, 'p_value': p_value, 'drift': psi > self.threshold},
+                            index=self.num_cols + self.ctg_cols)
+
+    def update(self, df: pd.DataFrame, analyzer: DataAnalyzer) -> pd.DataFrame:
+        """
+        Add batch to the window and compute drift scores
+
+        :param df: data
+        :param analyzer: data analyzer which has already analyzed the batch
+        :return: drift scores of features (None until the reference and the window are collected)
+        """
+        with metrics.timer('drift'):
+            if self.edges is None:
+                self.__init_bins(analyzer)
+
+            counts = self.__count(df)
+            if self.n_reference < self.window:
+                self.reference += counts
+                self.n_reference += 1
+                self.__save_state()
+                return None
+
+            self.recent.append(counts)
+            self.recent_sum += counts
+            if len(self.recent) > self.window:
+                self.recent_sum -= self.recent.popleft()
+            # Histograms of a few batches are too noisy to compare
+            scores = self.__scores() if len(self.recent) == self.window else None
+
+            self.__save_state()
+
+        return scores
+
+    def rebase(self):
+        """
+        Use the current window as the new reference (e.g. after model is retrained on drifted data)
+        """
+        if self.recent:
+            self.reference = self.recent_sum.copy()
+            self.recent.clear()
+            self.recent_sum = np.zeros_like(self.reference)
+            self.__save_state()
@@ -0,0 +1,137 @@
+import contextlib
+import json
+import threading
+import time
+import typing
+
+from src.utils import replace_atomically
+
+FORMATS = ['jsonl', 'prometheus']
+
+# Context returned by disabled timers
+_NO_TIMER = contextlib.nullcontext()
+
+
+class Instrumentation:
+    def __init__(self):
+        """
+        Instrumentation collects timers and counters of pipeline stages (reading data, analysis, transformation,
+        parameters search, evaluation, saving checkpoints, drawing).
+        It is disabled by default: then timers are a shared no-op context and counters return at once.
+        Timers may be nested, e.g. time of 'transform' is also counted in time of 'eval'
+        """
+        self.enabled = False
+        self.lock = threading.Lock()  # Stages may run in background threads
+        self.timers = {}  # Stage -> [number of calls, total time, maximum time] (in seconds)
+        self.counters = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+
+    def timer(self, stage: str) -> typing.ContextManager:
+        """
+        Measure time of a stage
+
+        :param stage: name of stage
+        :return: context manager
+        """
+        if not self.enabled:
+            return _NO_TIMER
+        return self.__timer(stage)
+
+    @contextlib.contextmanager
+    def __timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stats = self.timers.setdefault(stage, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+
+    def count(self, name: str, value=1):
+        """
+        Increase counter
+
+        :param name: name of counter
+        :param value: increment
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_json_lines(self, labels: dict[str, str] = None) -> str:
+        """
+        Format metrics as JSON lines (one line per timer or counter)
+
+        :param labels: labels added to every line (e.g. mode)
+        :return: text
+        """
+        labels = {} if labels is None else labels
+        now = time.time()
+        with self.lock:
+            lines = [{'time': now, **labels, 'type': 'timer', 'name': stage, 'count': n, 'sum': total, 'max': longest}
+                     for stage, (n, total, longest) in sorted(self.timers.items())]
+            lines += [{'time': now, **labels, 'type': 'counter', 'name': name, 'value': value}
+                      for name, value in sorted(self.counters.items())]
+        return ''.join(json.dumps(line) + '\n' for line in lines)
+
+    def to_prometheus(self, labels: dict[str, str] = None) -> str:
+        """
+        Format metrics in Prometheus text exposition format
+
+        :param labels: labels added to every sample (e.g. mode)
+        :return: text
+        """
+        labels = {} if labels is None else labels
+
+        def format_labels(extra: dict[str, str]) -> str:
+            pairs = {**labels, **extra}.items()
+            escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+            return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}' if escaped else ''
+
+        with self.lock:
+            timers = sorted(self.timers.items())
+            counters = sorted(self.counters.items())
+        lines = ['# HELP mlops_stage_seconds Time spent in pipeline stages', '# TYPE mlops_stage_seconds summary']
+        for stage, (n, total, _) in timers:
+            lines.append(f'mlops_stage_seconds_sum{format_labels({"stage": stage})} {total}')
+            lines.append(f'mlops_stage_seconds_count{format_labels({"stage": stage})} {n}')
+        lines += ['# HELP mlops_stage_max_seconds Longest call of pipeline stages',
+                  '# TYPE mlops_stage_max_seconds gauge']
+        for stage, (_, _, longest) in timers:
+            lines.append(f'mlops_stage_max_seconds{format_labels({"stage": stage})} {longest}')
+        for name, value in counters:
+            lines += [f'# TYPE mlops_{name}_total counter', f'mlops_{name}_total{format_labels({})} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str, fmt='jsonl', labels: dict[str, str] = None):
+        """
+        Save metrics. JSON lines are appended to the file, Prometheus text replaces the file
+        (e.g. for the textfile collector of node exporter)
+
+        :param path: path to file
+        :param fmt: 'jsonl' or 'prometheus'
+        :param labels: labels of metrics
+        """
+        assert fmt in FORMATS
+        if fmt == 'jsonl':
+            with open(path, 'a') as f:
+                f.write(self.to_json_lines(labels))
+        else:
+            with replace_atomically(path) as tmp_path:
+                with open(tmp_path, 'w') as f:
+                    f.write(self.to_prometheus(labels))
+
+
+# Instrumentation shared by all pipeline components
+metrics = Instrumentation()
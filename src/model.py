@@ -1,71 +1,272 @@
 import typing
+import numpy as np
 import pandas as pd
-from sklearn.model_selection import GridSearchCV
-from matplotlib import pyplot as plt
-from sklearn import tree
+from sklearn.base import clone
 
-from src.utils import read, save
+from src.utils import read
 from src.data_collector import DataCollector
+from src.checkpoint_store import CheckpointStore
+from src.instrumentation import metrics
 from src.data_transformer import DataTransformer
+from src.model_selector import ModelSelector
+from src.model_visualizer import ModelVisualizer
+from src.score_cache import ScoreCache
+from src.sharded_training import split_shards, fit_sharded
 
 
 class ModelPipeline:
-    def __init__(self, transformer: DataTransformer, model, param_grid: dict[str, typing.Any], path_to_save: str):
+    def __init__(self, transformer: DataTransformer, model, param_grid: dict[str, typing.Any], path_to_save: str = None,
+                 data: DataCollector = None, search='grid', n_jobs=1, n_candidates: int = None, random_state=0,
+                 cache: ScoreCache = None, visualizer: ModelVisualizer = None,
+                 incremental=False, reselect_every: int = 10, score_drop=0.1,
+                 n_new_trees=2, max_trees=32, n_recent=500, features='frame', shard_size: int = None):
         """
         ModelPipeline prepares data and then trains, evaluates, and validates model
 
         :param transformer: class to prepare data
         :param model: ML model from sklearn
-        :param param_grid: parameters for grid search
-        :param path_to_save: path to file with ModelPipeline state
+        :param param_grid: parameters for parameters search
+        :param path_to_save: path to directory with ModelPipeline state (see CheckpointStore; None for no saving)
+        :param data: storage for received data (unbounded DataCollector by default)
+        :param search: how to search parameters: 'grid', 'random' or 'halving' (see ModelSelector)
+        :param n_jobs: number of worker processes for parameters search
+        :param n_candidates: number of parameter combinations evaluated by random search
+        :param random_state: seed making the parameters search reproducible
+        :param cache: persistent cache of cross-validation scores and fitted models
+        :param visualizer: class to draw the selected model (None for no drawing)
+        :param incremental: if True, new data grows the selected forest instead of rerunning parameters search.
+            Parameters search is rerun every reselect_every batches, after a score drop or on request (e.g. on data drift)
+        :param reselect_every: number of batches between parameters searches in incremental mode (None for no schedule)
+        :param score_drop: decrease of score (compared to the first score after parameters search)
+            which triggers parameters search
+        :param n_new_trees: number of trees added to the forest per batch
+        :param max_trees: maximum number of trees in the forest (the oldest trees are retired)
+        :param n_recent: number of the latest samples used to train new trees
+        :param features: format of features the model is trained on: 'frame' for data frame;
+            'dense' for float32 array; 'sparse' for float32 CSR matrix (matrices take less memory)
+        :param shard_size: if set, the model is trained out of core: stored data is split into shards
+            of about shard_size rows, a sub-forest is trained on each shard in a worker process (n_jobs processes)
+            and sub-forests are merged into one forest. Parameters are searched on the latest shard.
+            Requires path_to_save; data should be bounded by shard_size rows (see DataCollector)
         """
-        self.data = DataCollector()
+        self.data = DataCollector() if data is None else data
         self.transformer = transformer
         self.model = None  # Best model selected by self.selector
-        self.selector = GridSearchCV(model, param_grid)
+        self.selector = ModelSelector(model, param_grid, method=search, n_jobs=n_jobs, n_candidates=n_candidates,
+                                      random_state=random_state, cache=cache)
         self.path_to_save = path_to_save
+        self.store = None if path_to_save is None else CheckpointStore(path_to_save)
+        self.visualizer = visualizer
 
-        self.__load_state()
+        self.incremental = incremental
+        self.reselect_every = reselect_every
+        self.score_drop = score_drop
+        self.n_new_trees = n_new_trees
+        self.max_trees = max_trees
+        self.n_recent = n_recent
+        self.features = features
+        self.shard_size = shard_size
+        # Progress since the last parameters search and number of trees ever grown (seeds of new trees)
+        self.status = {'batches': 0, 'reference_score': None, 'reselect': False, 'trees_grown': 0}
+
+        self.loaded = False  # State is loaded on first use
+
+    def load(self):
+        """
+        Load saved state. It is done automatically on first use of the pipeline
+        """
+        if not self.loaded:
+            self.loaded = True
+            self.__load_state()
 
     def __load_state(self):
+        if self.store is None:
+            return
+        if not self.store.exists():
+            self.__migrate_state()
+            return
+        meta = self.store.load_meta()
+        self.transformer = meta['transformer']
+        self.status = meta['status']
+        self.model = self.store.load_model()
+        for x, y in self.store.read_data(self.__recent_segments()):
+            self.data.add(x, y)
+
+    def __recent_segments(self) -> typing.Optional[range]:
+        """
+        Find segments which are loaded into memory: all segments, or the last shard in out-of-core mode
+        (the rest is read from the store when the forest is trained)
+
+        :return: numbers of segments (None for all)
+        """
+        if self.shard_size is None:
+            return None
+        sizes = self.store.segment_sizes()
+        start, n_rows = len(sizes), 0
+        while start > 0 and n_rows < self.shard_size:
+            n_rows += sizes[start - 1]
+            start -= 1
+        return range(start + 1, len(sizes) + 1)
+
+    def __migrate_state(self):
+        """
+        Convert state saved by an older version (a single pickle file)
+        """
         try:
-            self.data, self.transformer, self.model, self.selector = read(self.path_to_save)
+            state = read(self.path_to_save + '.pkl')
         except FileNotFoundError:
-            pass
+            return
+        data, self.transformer, self.model = state[:3]
+        if len(state) > 4:
+            self.status = state[4]
+        x, y = data.get()
+        if x is not None:
+            self.data.add(x, y)
+            self.store.append_data(x, y)
+        self.__save_state()
 
     def __save_state(self):
-        save(self.path_to_save, [self.data, self.transformer, self.model, self.selector])
+        if self.store is None:
+            return
+        with metrics.timer('checkpoint'):
+            if self.model is not None:
+                self.store.save_model(self.model)
+            self.store.commit({'transformer': self.transformer, 'status': self.status})
 
-    def fit(self, new_x: pd.DataFrame, new_y: pd.DataFrame):
-        self.data.add(new_x, new_y)
-        x, y = self.data.get()
-        x, y = self.transformer.prepare_train(x, y)
-        self.selector.fit(x, y)
+    def __output(self) -> str:
+        """
+        Format of features for the current model: a model trained on a data frame expects named features
+        """
+        if hasattr(self.model, 'feature_names_in_'):
+            return 'frame'
+        return 'dense' if self.features == 'frame' else self.features
+
+    def __need_selection(self) -> bool:
+        if not self.incremental or self.model is None or self.status['reselect']:
+            return True
+        return self.reselect_every is not None and self.status['batches'] >= self.reselect_every
+
+    def __select(self):
+        """
+        Select the best model by parameters search on all stored data
+        """
+        if self.shard_size is not None and self.store is not None:
+            self.__select_sharded()
+            return
+        columns, tables, index = self.data.get_encoded()
+        x, y = self.transformer.prepare_train_encoded(columns, tables, index, self.data.x_cols, self.data.y_cols,
+                                                      self.features)
+        with metrics.timer('cv_fit'):
+            self.selector.fit(x, y, config=(self.transformer.na_method, self.transformer.ctg_method))
         self.model = self.selector.best_estimator_
+        self.status.update({'batches': 0, 'reference_score': None, 'reselect': False})
 
-        self.__save_state()
+        if self.visualizer is not None:
+            self.visualizer.render(self.model)
 
-        fig, axes = plt.subplots(nrows=1, ncols=self.model.n_estimators, figsize=(10, 2), dpi=900)
-        for index in range(0, self.model.n_estimators):
-            tree.plot_tree(self.model.estimators_[index],
-                           filled=True,
-                           ax=axes[index])
+    def __select_sharded(self):
+        """
+        Select parameters on the latest data and train the forest shard by shard on all stored data
+        """
+        self.transformer.fit_stream(self.store.read_data())
+        x, y = self.data.get()
+        x, y = self.transformer.prepare_pred(x, y, self.features)
+        with metrics.timer('cv_fit'):
+            self.selector.fit(x, y, config=(self.transformer.na_method, self.transformer.ctg_method))
+        params = self.selector.best_params_
+        del x, y
+
+        # Each shard gets a share of trees proportional to its size
+        sizes = self.store.segment_sizes()
+        shards = split_shards(sizes, self.shard_size)
+        n_total = params.get('n_estimators', self.selector.model.get_params()['n_estimators'])
+        n_trees = [max(1, round(n_total * sum(sizes[k - 1] for k in shard) / sum(sizes))) for shard in shards]
+        with metrics.timer('shard_fit'):
+            model = fit_sharded(self.path_to_save, shards, self.transformer, self.selector.model, params, n_trees,
+                                self.features, self.selector.n_jobs)
+        self.model = self.selector.best_estimator_ if model is None else model
+        metrics.count('shards', len(shards))
+        self.status.update({'batches': 0, 'reference_score': None, 'reselect': False})
+
+        if self.visualizer is not None:
+            self.visualizer.render(self.model)
+
+    def __grow(self):
+        """
+        Add new trees trained on the latest data to the forest and retire the oldest trees
+        """
+        x, y = self.data.get()
+        x, y = self.transformer.prepare_pred(x.iloc[-self.n_recent:], y.iloc[-self.n_recent:], self.__output())
+        y = y.to_numpy().ravel()
+        # Trees trained on data without some classes can not be combined with the forest
+        if x.shape[0] == 0 or not np.array_equal(np.unique(y), self.model.classes_):
+            return
+
+        # New trees get seeds never used before: warm start would repeat seeds once old trees are retired
+        trees_grown = self.status.get('trees_grown', 0)
+        new_trees = clone(self.model).set_params(warm_start=False, n_estimators=self.n_new_trees,
+                                                 random_state=trees_grown)
+        with metrics.timer('grow'):
+            new_trees.fit(x, y)
+        self.model.estimators_ += new_trees.estimators_
+        self.model.n_estimators = len(self.model.estimators_)
+        self.status['trees_grown'] = trees_grown + self.n_new_trees
+        if len(self.model.estimators_) > self.max_trees:
+            self.model.estimators_ = self.model.estimators_[-self.max_trees:]
+            self.model.n_estimators = self.max_trees
+        self.status['batches'] += 1
+
+        if self.visualizer is not None:
+            self.visualizer.render(self.model)
 
-            axes[index].set_title('Estimator: ' + str(index), fontsize=11)
-        fig.savefig('best_model.png')
+    def request_reselection(self):
+        """
+        Rerun parameters search on the next fit (e.g. after data drift)
+        """
+        self.load()
+        self.status['reselect'] = True
+
+    def fit(self, new_x: pd.DataFrame, new_y: pd.DataFrame):
+        self.load()
+        self.data.add(new_x, new_y)
+        if self.store is not None:
+            self.store.append_data(new_x, new_y)
+        if self.__need_selection():
+            self.__select()
+        else:
+            self.__grow()
+
+        self.__save_state()
 
     def refit(self, x: pd.DataFrame, y: pd.DataFrame):
-        x, y = self.transformer.prepare_train(x, y)
-        self.model.fit(x, y)
+        self.load()
+        self.data.add(x, y)
+        if self.store is not None:
+            self.store.append_data(x, y)
+        self.__grow()
+
+        self.__save_state()
 
     def predict(self, x: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
-        x, _ = self.transformer.prepare_pred(x)
-        y = pd.DataFrame({'predicted': self.model.predict(x)})
+        self.load()
+        with metrics.timer('predict'):
+            x, _ = self.transformer.prepare_pred(x, output=self.__output())
+            y = pd.DataFrame({'predicted': self.model.predict(x)}, index=self.transformer.index)
         return x, y
 
     def eval(self, x: pd.DataFrame, y: pd.DataFrame) -> float:
-        x, y = self.transformer.prepare_pred(x, y)
-        return self.model.score(x, y)
+        self.load()
+        with metrics.timer('eval'):
+            x, y = self.transformer.prepare_pred(x, y, self.__output())
+            score = self.model.score(x, y)
+
+        if self.status['reference_score'] is None:
+            self.status['reference_score'] = score
+        elif score < self.status['reference_score'] - self.score_drop:
+            self.request_reselection()
+
+        return score
 
     def is_fit(self) -> bool:
+        self.load()
         return self.model is not None
@@ -0,0 +1,189 @@
+import math
+import typing
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid, StratifiedKFold
+
+from src.score_cache import ScoreCache
+from src.instrumentation import metrics
+
+
+def _fit_and_score(model, params: dict[str, typing.Any], x: typing.Union[np.ndarray, sparse.csr_matrix],
+                   y: np.ndarray, train: np.ndarray, test: np.ndarray) -> float:
+    """
+    Train model with given parameters on one fold and score it on the rest of data
+
+    :param model: ML model from sklearn
+    :param params: model parameters
+    :param x: features
+    :param y: target
+    :param train: indices of training samples
+    :param test: indices of test samples
+    :return: score
+    """
+    model = clone(model).set_params(**params)
+    model.fit(x[train], y[train])
+    return model.score(x[test], y[test])
+
+
+class ModelSelector:
+    def __init__(self, model, param_grid: dict[str, typing.Any], method='grid', n_jobs=1, n_candidates: int = None,
+                 factor=3, cv=5, random_state=0, cache: ScoreCache = None):
+        """
+        ModelSelector selects model parameters by cross-validation
+
+        :param model: ML model from sklearn
+        :param param_grid: parameters grid
+        :param method: how to search parameters:
+            'grid' for evaluating all combinations;
+            'random' for evaluating n_candidates random combinations;
+            'halving' for successive halving: all combinations are evaluated on a small subsample,
+            and only the best 1/factor of them are evaluated on a factor times bigger subsample
+        :param n_jobs: number of worker processes
+        :param n_candidates: number of combinations evaluated by 'random' method
+        :param factor: reduction factor of 'halving' method
+        :param cv: number of cross-validation folds
+        :param random_state: seed making the search reproducible
+        :param cache: cache of fold scores and fitted models (folds evaluated earlier on the same data are skipped)
+        """
+        assert method in ['grid', 'random', 'halving']
+
+        self.model = model
+        self.param_grid = param_grid
+        self.method = method
+        self.n_jobs = n_jobs
+        self.n_candidates = n_candidates
+        self.factor = factor
+        self.cv = cv
+        self.random_state = random_state
+        self.cache = cache
+
+        self.best_params_ = None
+        self.best_score_ = None
+        self.best_estimator_ = None
+        self.cv_results_ = None
+
+    def __get_candidates(self) -> list[dict[str, typing.Any]]:
+        candidates = list(ParameterGrid(self.param_grid))
+        if self.method == 'random' and self.n_candidates is not None and self.n_candidates < len(candidates):
+            rng = np.random.default_rng(self.random_state)
+            chosen = np.sort(rng.choice(len(candidates), self.n_candidates, replace=False))
+            candidates = [candidates[i] for i in chosen]
+        if 'random_state' in self.model.get_params() and self.model.get_params()['random_state'] is None:
+            candidates = [{**params, 'random_state': self.random_state} for params in candidates]
+        return candidates
+
+    def __evaluate(self, candidates: list[dict[str, typing.Any]], x: typing.Union[np.ndarray, sparse.csr_matrix],
+                   y: np.ndarray, samples: np.ndarray, data_key: str) -> np.ndarray:
+        """
+        Evaluate parameter combinations by cross-validation on a subsample
+
+        :param candidates: parameter combinations
+        :param x: features
+        :param y: target
+        :param samples: indices of the subsample
+        :param data_key: fingerprint of data
+        :return: mean scores of combinations
+        """
+        folds = StratifiedKFold(self.cv, shuffle=True, random_state=self.random_state)
+        folds = [(samples[train], samples[test]) for train, test in folds.split(samples, y[samples])]
+        tasks = [(params, i) for params in candidates for i in range(len(folds))]
+
+        scores = np.empty(len(tasks))
+        keys = [ScoreCache.key(data_key, self.cv, self.random_state, samples.shape[0], i, sorted(params.items()))
+                for params, i in tasks]
+        todo = []
+        for t, key in enumerate(keys):
+            score = None if self.cache is None else self.cache.get_score(key)
+            if score is None:
+                todo.append(t)
+            else:
+                scores[t] = score
+
+        metrics.count('cv_fits', len(todo))
+        metrics.count('cv_cache_hits', len(tasks) - len(todo))
+        # Scores arrive in order as they are computed
+        new_scores = Parallel(n_jobs=self.n_jobs, return_as='generator')(
+            delayed(_fit_and_score)(self.model, tasks[t][0], x, y, *folds[tasks[t][1]])
+            for t in todo
+        )
+        for t, score in zip(todo, new_scores):
+            scores[t] = score
+            if self.cache is not None:
+                # The cache saves its index every flush_every scores, so that they survive a crash during the search
+                self.cache.put_score(keys[t], score)
+
+        return scores.reshape(len(candidates), len(folds)).mean(axis=1)
+
+    def fit(self, x: typing.Union[pd.DataFrame, np.ndarray, sparse.csr_matrix], y: pd.DataFrame,
+            config: typing.Any = None):
+        """
+        Select the best parameters and train model with them on all data
+
+        :param x: features (data frame, array or CSR matrix)
+        :param y: target
+        :param config: description of data preparation (distinguishes cache entries)
+        """
+        candidates = self.__get_candidates()
+        # Trees split float32 features, so a data frame is converted to float32 rather than to a twice larger copy
+        x_arr = x.to_numpy(dtype=np.float32) if isinstance(x, pd.DataFrame) else x
+        y_arr = y.to_numpy().ravel()
+        data_key = None
+        if self.cache is not None:
+            columns = x.columns.tolist() if isinstance(x, pd.DataFrame) else None
+            contents = [x_arr.data, x_arr.indices, x_arr.indptr] if sparse.issparse(x_arr) else [x_arr]
+            data_key = ScoreCache.key(config, columns, *contents, y_arr, type(self.model).__name__,
+                                      sorted(self.model.get_params().items()))
+        n_samples = y_arr.shape[0]
+        # Nested subsamples of growing size are prefixes of one permutation
+        permutation = np.random.default_rng(self.random_state).permutation(n_samples)
+
+        if self.method == 'halving':
+            # floor(log_factor(n_candidates)) + 1 rounds as in HalvingGridSearchCV (counted exactly in integers)
+            n_rounds = 1
+            while self.factor ** n_rounds <= len(candidates):
+                n_rounds += 1
+            min_resources = self.cv * 2 * np.unique(y_arr).shape[0]
+            resources = max(n_samples // self.factor ** (n_rounds - 1), min_resources)
+        else:
+            n_rounds = 1
+            resources = n_samples
+
+        results = {'params': [], 'mean_test_score': [], 'n_resources': []}
+        for i in range(n_rounds):
+            n = min(resources * self.factor ** i, n_samples)
+            scores = self.__evaluate(candidates, x_arr, y_arr, permutation[:n], data_key)
+            results['params'] += candidates
+            results['mean_test_score'] += scores.tolist()
+            results['n_resources'] += [n] * len(candidates)
+
+            # Stable order keeps the first of equally good candidates
+            order = np.argsort(-scores, kind='stable')
+            best_score = scores[order[0]]
+            if i == n_rounds - 1 or n == n_samples:
+                candidates = [candidates[order[0]]]
+                break
+            n_keep = max(math.ceil(len(candidates) / self.factor), 1)
+            candidates = [candidates[j] for j in np.sort(order[:n_keep])]
+            if len(candidates) == 1:
+                # The only survivor has already won, evaluating it on more data changes nothing
+                break
+
+        self.cv_results_ = results
+        self.best_params_ = candidates[0]
+        self.best_score_ = best_score
+        self.best_estimator_ = None
+        if self.cache is not None:
+            model_key = ScoreCache.key(data_key, sorted(self.best_params_.items()))
+            self.best_estimator_ = self.cache.get_model(model_key)
+        if self.best_estimator_ is None:
+            self.best_estimator_ = clone(self.model).set_params(**self.best_params_)
+            self.best_estimator_.fit(x, y_arr)
+            if self.cache is not None:
+                self.cache.put_model(model_key, self.best_estimator_)
+        if self.cache is not None:
+            self.cache.flush()
+        return self
@@ -0,0 +1,97 @@
+import os
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src.instrumentation import metrics
+
+
+class ModelVisualizer:
+    def __init__(self, path='best_model.png', max_depth=3, max_trees=4, dpi=300, background=True):
+        """
+        ModelVisualizer draws trees of the selected forest
+
+        :param path: path to output image
+        :param max_depth: maximum depth of drawn trees
+        :param max_trees: maximum number of drawn trees
+        :param dpi: image resolution
+        :param background: if True, draw in a background thread (only the latest model is drawn)
+        """
+        self.path = path
+        self.max_depth = max_depth
+        self.max_trees = max_trees
+        self.dpi = dpi
+        self.background = background
+
+        self.drawn = None  # Fingerprint of parameters and drawn trees of the last drawn model
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.lock = threading.Lock()
+        self.pending = None  # Trees waiting to be drawn
+
+    def __draw(self, estimators: list):
+        # Import matplotlib only when something is drawn
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from sklearn import tree
+
+        with metrics.timer('plot'):
+            fig = Figure(figsize=(10, 2), dpi=self.dpi)
+            FigureCanvasAgg(fig)
+            axes = fig.subplots(nrows=1, ncols=len(estimators), squeeze=False)[0]
+            for index, estimator in enumerate(estimators):
+                tree.plot_tree(estimator, max_depth=self.max_depth, filled=True, ax=axes[index])
+                axes[index].set_title('Estimator: ' + str(index), fontsize=11)
+            # Do not leave a partially written image if drawing is interrupted
+            root, ext = os.path.splitext(self.path)
+            tmp_path = f'{root}.tmp{ext}'
+            fig.savefig(tmp_path)
+            os.replace(tmp_path, self.path)
+
+    def __draw_pending(self):
+        with self.lock:
+            estimators, self.pending = self.pending, None
+        if estimators is None:
+            return
+        try:
+            self.__draw(estimators)
+        except Exception:
+            logging.exception('Failed to draw model')
+
+    @staticmethod
+    def fingerprint(model, estimators: list) -> str:
+        """
+        Identify the image of a model: its parameters and the structure of the drawn trees
+
+        :param model: fitted forest
+        :param estimators: drawn trees
+        :return: fingerprint
+        """
+        h = hashlib.sha1(repr(sorted(model.get_params().items())).encode())
+        for estimator in estimators:
+            for array in [estimator.tree_.feature, estimator.tree_.threshold, estimator.tree_.value]:
+                h.update(array.tobytes())
+        return h.hexdigest()
+
+    def render(self, model):
+        """
+        Draw model if it differs from the last drawn model: its parameters or drawn trees changed
+        (e.g. the model is refitted on new data with the same parameters or its oldest trees are retired)
+
+        :param model: fitted forest
+        """
+        # Copy the list of trees, since the forest may grow while it is drawn
+        estimators = model.estimators_[:self.max_trees]
+        drawn = self.fingerprint(model, estimators)
+        if drawn == self.drawn:
+            return
+        self.drawn = drawn
+
+        if not self.background:
+            self.__draw(estimators)
+            return
+        with self.lock:
+            queued = self.pending is not None
+            self.pending = estimators
+        if not queued:
+            self.executor.submit(self.__draw_pending)
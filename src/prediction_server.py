@@ -0,0 +1,259 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+import typing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from src.checkpoint_store import CheckpointStore
+from src.compiled_forest import CompiledForest
+
+
+class PredictionServer:
+    def __init__(self, path_to_save: str, host='127.0.0.1', port=8000, max_batch_size=256, max_delay=0.002,
+                 reload_interval=1.0, metrics_window=10000):
+        """
+        PredictionServer is an HTTP server which keeps the fitted transformer and model in memory
+        compiled into CompiledForest.
+        Concurrent requests are grouped into micro-batches, the model is reloaded when a new checkpoint is committed.
+
+        Endpoints:
+            POST /predict takes a JSON record or a list of records and returns {"predicted": [...]}
+            (null for records which can not be processed, e.g. with unknown categories);
+            GET /metrics returns latency percentiles and counters
+
+        :param path_to_save: path to directory with ModelPipeline state (see CheckpointStore)
+        :param host: host to listen on
+        :param port: port to listen on
+        :param max_batch_size: number of records after which a micro-batch is not extended with other requests
+        :param max_delay: time (in seconds) a micro-batch waits for other requests
+        :param reload_interval: time (in seconds) between checks for a new checkpoint
+        :param metrics_window: number of the latest requests used to compute latency percentiles
+        """
+        self.store = CheckpointStore(path_to_save)
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.reload_interval = reload_interval
+
+        self.forest = None  # Compiled transformer and model
+        self.version = None  # Modification time of the loaded checkpoint
+        self.queue = None  # Requests waiting for a micro-batch
+        # Predictions and reloads are made in a single thread so that the event loop keeps accepting requests
+        self.executor = ThreadPoolExecutor(1)
+
+        # Metrics
+        self.latencies = collections.deque(maxlen=metrics_window)
+        self.n_requests = 0
+        self.n_records = 0
+        self.n_batches = 0
+        self.n_errors = 0
+        self.n_reloads = 0
+
+    def __checkpoint_version(self) -> typing.Optional[int]:
+        try:
+            return os.stat(self.store.path_to_meta).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self) -> bool:
+        """
+        Load transformer and model if a new checkpoint has been committed
+
+        :return: True if a new checkpoint is loaded
+        """
+        version = self.__checkpoint_version()
+        if version is None or version == self.version:
+            return False
+        # Model is loaded from the file referred to by the same metadata as the transformer
+        transformer = self.store.load_meta()['transformer']
+        model = self.store.load_model()
+        if model is None:
+            # No model yet, or the checkpoint has been replaced meanwhile: retry on the next check
+            return False
+        self.forest = CompiledForest(transformer, model)
+        self.version = version
+        self.n_reloads += 1
+        logging.info(f'Prediction server loaded checkpoint {version}')
+        return True
+
+    @staticmethod
+    def __parse(records: list[dict[str, typing.Any]], forest: CompiledForest) -> pd.DataFrame:
+        """
+        Convert JSON records to data with columns expected by the predictor.
+        Absent fields are treated as missing values, unexpected fields are ignored
+
+        :param records: records
+        :param forest: predictor
+        :return: data
+        """
+        columns = {}
+        for col in forest.num_cols:
+            values = [record.get(col) for record in records]
+            try:
+                # Missing values (null) become NaN
+                columns[col] = np.array(values, dtype=np.float64)
+            except (TypeError, ValueError):
+                columns[col] = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(np.float64)
+        for col in forest.ctg_cols:
+            columns[col] = np.array([record.get(col) for record in records], dtype=object)
+        return pd.DataFrame(columns)
+
+    def __predict(self, records: list[dict[str, typing.Any]]) -> list[typing.Any]:
+        """
+        Make predictions for a micro-batch
+
+        :param records: records
+        :return: predictions (None for records removed by the transformer)
+        """
+        forest = self.forest
+        y = forest.predict(self.__parse(records, forest))
+        predicted = np.full(len(records), None, dtype=object)
+        predicted[y.index.to_numpy()] = y['predicted'].tolist()
+        return predicted.tolist()
+
+    async def __process_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for the first request and give other requests a chance to join it
+            requests = [await self.queue.get()]
+            n = len(requests[0][0])
+            if n < self.max_batch_size and self.max_delay > 0:
+                await asyncio.sleep(self.max_delay)
+            while n < self.max_batch_size and not self.queue.empty():
+                requests.append(self.queue.get_nowait())
+                n += len(requests[-1][0])
+
+            records = [record for request_records, _ in requests for record in request_records]
+            try:
+                predicted = await loop.run_in_executor(self.executor, self.__predict, records)
+            except Exception as e:
+                logging.exception('Prediction failed')
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.n_batches += 1
+            start = 0
+            for request_records, future in requests:
+                if not future.done():  # The client may have disconnected
+                    future.set_result(predicted[start:start + len(request_records)])
+                start += len(request_records)
+
+    async def __watch_checkpoints(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await loop.run_in_executor(self.executor, self.reload)
+            except Exception:
+                logging.exception('Checkpoint reload failed')
+
+    def metrics(self) -> dict[str, typing.Any]:
+        """
+        Get server metrics
+
+        :return: dict with request counters and latency percentiles (in milliseconds)
+        """
+        latencies = np.array(self.latencies) * 1000
+        p50, p99 = np.percentile(latencies, [50, 99]).tolist() if latencies.size else (None, None)
+        return {
+            'requests': self.n_requests,
+            'records': self.n_records,
+            'batches': self.n_batches,
+            'mean_batch_size': self.n_records / self.n_batches if self.n_batches else None,
+            'errors': self.n_errors,
+            'latency_ms_p50': p50,
+            'latency_ms_p99': p99,
+            'model_version': self.version,
+            'reloads': self.n_reloads,
+        }
+
+    async def __predict_request(self, body: bytes) -> tuple[str, dict[str, typing.Any]]:
+        start = time.perf_counter()
+        if self.forest is None:
+            return '503 Service Unavailable', {'error': 'Model is not fitted'}
+        try:
+            records = json.loads(body)
+        except ValueError:
+            return '400 Bad Request', {'error': 'Body is not JSON'}
+        if isinstance(records, dict):
+            records = [records]
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            return '400 Bad Request', {'error': 'Body must be a record or a list of records'}
+        if not records:
+            return '200 OK', {'predicted': []}
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((records, future))
+        try:
+            predicted = await future
+        except Exception as e:
+            self.n_errors += 1
+            return '500 Internal Server Error', {'error': str(e)}
+
+        self.latencies.append(time.perf_counter() - start)
+        self.n_requests += 1
+        self.n_records += len(records)
+        return '200 OK', {'predicted': predicted}
+
+    async def __route(self, method: str, path: str, body: bytes) -> tuple[str, dict[str, typing.Any]]:
+        if method == 'POST' and path == '/predict':
+            return await self.__predict_request(body)
+        if method == 'GET' and path == '/metrics':
+            return '200 OK', self.metrics()
+        return '404 Not Found', {'error': f'Unknown endpoint {method} {path}'}
+
+    async def __handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Connections are kept alive until the client closes them
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, response = await self.__route(method, path, body)
+                payload = json.dumps(response).encode()
+                writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """
+        Load the latest checkpoint and serve requests until cancelled
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.reload)
+        self.queue = asyncio.Queue()
+        server = await asyncio.start_server(self.__handle_connection, self.host, self.port)
+        print(f'Serving on http://{self.host}:{self.port}')
+        tasks = [asyncio.create_task(self.__process_batches()), asyncio.create_task(self.__watch_checkpoints())]
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def run(self):
+        asyncio.run(self.serve())
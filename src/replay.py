@@ -0,0 +1,102 @@
+import time
+import queue
+import typing
+import threading
+
+CLOCKS = ['realtime', 'scaled', 'fast']
+
+
+class ReplayClock:
+    def __init__(self, mode='realtime', pause=3.0, speed=1.0):
+        """
+        ReplayClock schedules arrivals of replayed batches.
+        Batches arrive at fixed intervals from each other, so time spent on processing a batch is not added
+        to the pause; if processing takes longer than the interval, the next batch arrives at once
+
+        :param mode: 'realtime' for intervals of pause seconds;
+            'scaled' for intervals of pause / speed seconds;
+            'fast' for no pauses
+        :param pause: interval between batches (in seconds) in real time
+        :param speed: acceleration of the 'scaled' clock
+        """
+        assert mode in CLOCKS
+        assert speed > 0
+
+        self.interval = {'realtime': pause, 'scaled': pause / speed, 'fast': 0}[mode]
+        self.next_arrival = None
+
+    def wait(self):
+        """
+        Wait for arrival of the next batch (the first batch arrives at once)
+        """
+        now = time.monotonic()
+        if self.next_arrival is not None and self.next_arrival > now:
+            time.sleep(self.next_arrival - now)
+            now = self.next_arrival
+        self.next_arrival = now + self.interval
+
+
+class Prefetcher:
+    def __init__(self, produce: typing.Callable[[], typing.Any], depth=2):
+        """
+        Prefetcher prepares items (e.g. read and analyzed batches) in a background thread
+        while the caller processes previous items. At most depth prepared items wait in the queue.
+        Components used by produce should not save their state themselves: the caller commits it
+        after an item is processed, so that prefetched items are not lost if the process stops
+
+        :param produce: function which prepares the next item (None at the end of data)
+        :param depth: number of items prepared ahead (0 for preparing items in the caller thread)
+        """
+        self.produce = produce
+        self.depth = depth
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.stopped = threading.Event()
+        self.thread = None
+        if depth > 0:
+            self.thread = threading.Thread(target=self.__run, daemon=True)
+            self.thread.start()
+
+    def __put(self, item: typing.Any) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __run(self):
+        try:
+            while True:
+                item = self.produce()
+                if not self.__put((item, None)) or item is None:
+                    return
+        except BaseException as e:
+            self.__put((None, e))
+
+    def get(self) -> typing.Any:
+        """
+        Get the next prepared item. Errors raised by produce are raised here
+
+        :return: item (None at the end of data)
+        """
+        if self.thread is None:
+            return self.produce()
+        item, error = self.queue.get()
+        if error is not None:
+            raise error
+        return item
+
+    def close(self):
+        """
+        Stop preparing items. Items which are not taken are dropped
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self) -> 'Prefetcher':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
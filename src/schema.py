@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+from src.utils import read, save
+
+# Integer types tried when integer columns are downcast
+INT_TYPES = [np.int8, np.int16, np.int32, np.int64]
+
+
+def is_categorical(values: pd.Series) -> bool:
+    """
+    Check whether a column holds categories (strings or pandas categorical)
+
+    :param values: column
+    :return: True for categorical column
+    """
+    return values.dtype == 'object' or isinstance(values.dtype, pd.CategoricalDtype)
+
+
+def categorical_columns(df: pd.DataFrame) -> list[str]:
+    return [col for col in df.columns if is_categorical(df[col])]
+
+
+def get_indexer(index: pd.Index, values: pd.Series) -> np.ndarray:
+    """
+    Find positions of values in index. Pandas categorical values are looked up by their categories only
+
+    :param index: index
+    :param values: values
+    :return: positions (-1 for missing or unknown values)
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        positions = np.append(index.get_indexer(values.cat.categories), -1)
+        return positions[values.cat.codes.to_numpy()]
+    return index.get_indexer(values)
+
+
+class Schema:
+    def __init__(self, path_to_save: str = None):
+        """
+        Schema infers and enforces compact column types of received data:
+        categorical columns become pandas categorical with a global dictionary (new categories are appended,
+        so codes of known categories never change), integer columns are downcast to the smallest type
+        holding the values seen so far, float columns are stored as float32 (models cast features to float32 anyway).
+        Types only widen: a column is converted to a wider type when new values do not fit
+
+        :param path_to_save: path to file with Schema state (None for no saving)
+        """
+        self.path_to_save = path_to_save
+        self.dtypes = {}  # Column -> dtype
+
+        self.__load_state()
+
+    def __load_state(self):
+        if self.path_to_save is None:
+            return
+        try:
+            self.dtypes = read(self.path_to_save)
+        except FileNotFoundError:
+            pass
+
+    def __save_state(self):
+        if self.path_to_save is not None:
+            save(self.path_to_save, self.dtypes)
+
+    def csv_dtypes(self) -> dict[str, str]:
+        """
+        Get types of categorical columns to parse CSV files with
+
+        :return: dict {column: 'category'}
+        """
+        return {col: 'category' for col, dtype in self.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)}
+
+    @staticmethod
+    def __update_dtype(values: pd.Series, dtype):
+        """
+        Find type which holds both values and values of the given type
+
+        :param values: values
+        :param dtype: current type of the column (None for unknown column)
+        :return: new type (dtype itself if it holds values)
+        """
+        if is_categorical(values) or isinstance(dtype, pd.CategoricalDtype):
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                uniques = values.cat.categories
+            else:
+                uniques = pd.Index(pd.unique(values.dropna().to_numpy()))
+            if not isinstance(dtype, pd.CategoricalDtype):
+                return pd.CategoricalDtype(uniques)
+            new = uniques[dtype.categories.get_indexer(uniques) < 0]
+            return pd.CategoricalDtype(dtype.categories.append(new)) if len(new) else dtype
+
+        if values.dtype.kind in 'iu':
+            if dtype is not None and dtype.kind == 'f':
+                return dtype
+            if values.empty:
+                return np.dtype(np.int8) if dtype is None else dtype
+            low, high = values.min(), values.max()
+            fitting = next(np.dtype(t) for t in INT_TYPES if np.iinfo(t).min <= low and high <= np.iinfo(t).max)
+            return fitting if dtype is None else np.result_type(dtype, fitting)
+        if values.dtype.kind == 'f':
+            return np.dtype(np.float32) if dtype is None or dtype.kind in 'iuf' else dtype
+        return values.dtype
+
+    def infer(self, df: pd.DataFrame):
+        """
+        Infer types of columns which are not in the schema yet
+
+        :param df: data
+        """
+        new = {col: self.__update_dtype(df[col], None) for col in df.columns if col not in self.dtypes}
+        if new:
+            self.dtypes.update(new)
+            self.__save_state()
+
+    def cast(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Convert columns to types of the schema (e.g. data converted earlier, whose dictionaries are shorter)
+
+        :param df: data
+        :return: converted data
+        """
+        columns = {}
+        for col in df.columns:
+            values = df[col]
+            dtype = self.dtypes.get(col, values.dtype)
+            if isinstance(dtype, pd.CategoricalDtype) and isinstance(values.dtype, pd.CategoricalDtype):
+                # Categorical dtypes with the same categories in another order are equal, so codes are remapped
+                if not values.cat.categories.equals(dtype.categories):
+                    values = values.cat.set_categories(dtype.categories)
+            elif values.dtype != dtype:
+                values = values.astype(dtype)
+            columns[col] = values
+        return pd.DataFrame(columns, index=df.index, copy=False)
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Extend the schema with new categories and values out of the range of types, then convert data
+
+        :param df: data
+        :return: converted data
+        """
+        changed = False
+        for col in df.columns:
+            dtype = self.dtypes.get(col)
+            new = self.__update_dtype(df[col], dtype)
+            if new is not dtype and (dtype is None or new != dtype):
+                self.dtypes[col] = new
+                changed = True
+        if changed:
+            self.__save_state()
+        return self.cast(df)
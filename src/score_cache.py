@@ -0,0 +1,131 @@
+import os
+import pickle
+import typing
+import hashlib
+import logging
+from collections import OrderedDict
+
+from src.utils import read, save
+
+
+class ScoreCache:
+    def __init__(self, path_to_save: str, max_entries=100000, max_bytes=256 * 2 ** 20, flush_every=100):
+        """
+        ScoreCache stores cross-validation scores and fitted models on disk.
+        The least recently used entries are evicted when the cache exceeds its limits.
+        A damaged index (e.g. a truncated file) resets the cache
+
+        :param path_to_save: path to directory with cache
+        :param max_entries: maximum number of entries
+        :param max_bytes: maximum total size of files with fitted models
+        :param flush_every: number of new entries after which the index is saved (so that entries survive a crash
+            during a long search); the index is also saved by flush
+        """
+        self.path_to_save = path_to_save
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.entries = None  # Key -> (score, None) or (None, size of file with model)
+        self.n_bytes = 0
+        self.n_unsaved = 0  # Number of entries added after the index was saved
+
+    @staticmethod
+    def key(*parts: typing.Any) -> str:
+        """
+        Make a key from hashable parts (arrays are hashed by their contents)
+
+        :param parts: parts of the key
+        :return: key
+        """
+        h = hashlib.sha1()
+        for part in parts:
+            h.update(part.tobytes() if hasattr(part, 'tobytes') else repr(part).encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def __path(self, name: str) -> str:
+        return os.path.join(self.path_to_save, name)
+
+    def __load(self):
+        if self.entries is not None:
+            return
+        os.makedirs(self.path_to_save, exist_ok=True)
+        try:
+            self.entries = read(self.__path('index.pkl'))
+        except FileNotFoundError:
+            self.entries = OrderedDict()
+        except (EOFError, pickle.UnpicklingError):
+            logging.warning('Index of score cache is damaged, the cache is reset')
+            self.entries = OrderedDict()
+            # Files of fitted models are not referenced by the index any more
+            for name in os.listdir(self.path_to_save):
+                if name.endswith('.pkl'):
+                    os.remove(self.__path(name))
+        self.n_bytes = sum(size for _, size in self.entries.values() if size is not None)
+
+    def __evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.n_bytes > self.max_bytes):
+            key, (_, size) = self.entries.popitem(last=False)
+            if size is not None:
+                self.n_bytes -= size
+                try:
+                    os.remove(self.__path(f'{key}.pkl'))
+                except FileNotFoundError:
+                    pass
+
+    def get_score(self, key: str) -> typing.Optional[float]:
+        self.__load()
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def __added(self):
+        self.__evict()
+        self.n_unsaved += 1
+        if self.n_unsaved >= self.flush_every:
+            self.flush()
+
+    def put_score(self, key: str, score: float):
+        self.__load()
+        self.entries[key] = (score, None)
+        self.__added()
+
+    def get_model(self, key: str) -> typing.Any:
+        self.__load()
+        if key not in self.entries:
+            return None
+        try:
+            model = read(self.__path(f'{key}.pkl'))
+        except FileNotFoundError:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return model
+
+    def put_model(self, key: str, model: typing.Any):
+        self.__load()
+        if key in self.entries and self.entries[key][1] is not None:
+            self.n_bytes -= self.entries[key][1]
+        fn = self.__path(f'{key}.pkl')
+        save(fn, model)
+        self.entries[key] = (None, os.path.getsize(fn))
+        self.n_bytes += self.entries[key][1]
+        self.__added()
+
+    def flush(self):
+        """
+        Save index of the cache
+        """
+        if self.entries is not None:
+            save(self.__path('index.pkl'), self.entries)
+            self.n_unsaved = 0
+
+    def __getstate__(self) -> dict:
+        # The index is read from disk on first use
+        state = self.__dict__.copy()
+        state['entries'] = None
+        state['n_bytes'] = 0
+        state['n_unsaved'] = 0
+        return state
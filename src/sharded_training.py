@@ -0,0 +1,139 @@
+import typing
+import logging
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from concurrent.futures import ProcessPoolExecutor
+
+from src.data_collector import DataCollector
+from src.checkpoint_store import CheckpointStore
+from src.data_transformer import DataTransformer
+from src.instrumentation import metrics
+
+# Store, fitted transformer and format of features of the current worker process
+_worker_state = {}
+
+
+def split_shards(sizes: list[int], shard_size: int) -> list[range]:
+    """
+    Group consecutive data segments into shards of at least shard_size rows (the last shard may be smaller)
+
+    :param sizes: numbers of rows of segments 1, 2, ...
+    :param shard_size: number of rows in a shard
+    :return: numbers of segments of each shard
+    """
+    shards = []
+    start, n_rows = 1, 0
+    for k, size in enumerate(sizes, start=1):
+        n_rows += size
+        if n_rows >= shard_size:
+            shards.append(range(start, k + 1))
+            start, n_rows = k + 1, 0
+    if start <= len(sizes):
+        shards.append(range(start, len(sizes) + 1))
+    return shards
+
+
+def read_shard(store: CheckpointStore, segments: range) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Read data segments of a shard into memory
+
+    :param store: store with data segments
+    :param segments: numbers of segments
+    :return: data (x, y)
+    """
+    data = DataCollector()
+    for x, y in store.read_data(segments):
+        data.add(x, y)
+    return data.get()
+
+
+def _init_worker(path_to_save: str, transformer: DataTransformer, output: str):
+    """
+    Receive fitted transformer once per worker process
+
+    :param path_to_save: path to directory with ModelPipeline state
+    :param transformer: transformer fitted on all shards
+    :param output: format of features
+    """
+    _worker_state['store'] = CheckpointStore(path_to_save)
+    _worker_state['transformer'] = transformer
+    _worker_state['output'] = output
+
+
+def _fit_shard(segments: range, model, params: dict[str, typing.Any]):
+    """
+    Train a sub-forest on one shard
+
+    :param segments: numbers of segments of the shard
+    :param model: ML model from sklearn
+    :param params: model parameters
+    :return: fitted model (None for a shard without rows)
+    """
+    x, y = read_shard(_worker_state['store'], segments)
+    if x is None:
+        return None
+    x, y = _worker_state['transformer'].prepare_pred(x, y, _worker_state['output'])
+    if x.shape[0] == 0:
+        return None
+    return clone(model).set_params(**params).fit(x, y.to_numpy().ravel())
+
+
+def merge_forests(forests: list[typing.Any]) -> typing.Any:
+    """
+    Combine fitted forests into one forest containing all their trees.
+    Trees of a forest trained on data without some classes can not be combined with others, so such forests are skipped
+    (they are logged and counted as shard_trees_dropped)
+
+    :param forests: fitted forests (e.g. RandomForestClassifier)
+    :return: forest (the first of the combined forests, extended with trees of the rest; None if there is none)
+    """
+    forests = [forest for forest in forests if forest is not None]
+    if not forests:
+        return None
+    classes = np.unique(np.concatenate([forest.classes_ for forest in forests]))
+    dropped = [forest for forest in forests if not np.array_equal(forest.classes_, classes)]
+    if dropped:
+        n_trees = sum(len(forest.estimators_) for forest in dropped)
+        logging.warning(f'{len(dropped)} sub-forests ({n_trees} trees) trained without some classes are dropped')
+        metrics.count('shard_trees_dropped', n_trees)
+    forests = [forest for forest in forests if np.array_equal(forest.classes_, classes)]
+    if not forests:
+        return None
+
+    merged = forests[0]
+    merged.estimators_ = [estimator for forest in forests for estimator in forest.estimators_]
+    merged.n_estimators = len(merged.estimators_)
+    return merged
+
+
+def fit_sharded(path_to_save: str, shards: list[range], transformer: DataTransformer, model,
+                params: dict[str, typing.Any], n_trees: list[int], output='frame', n_workers=1) -> typing.Any:
+    """
+    Out-of-core training: train a sub-forest on each shard of stored data and merge sub-forests into one forest.
+    Each worker process holds only one shard in memory
+
+    :param path_to_save: path to directory with ModelPipeline state (data segments are read from it)
+    :param shards: numbers of segments of each shard
+    :param transformer: transformer fitted on all shards (see DataTransformer.fit_stream)
+    :param model: ML model from sklearn (forest)
+    :param params: model parameters
+    :param n_trees: number of trees of each sub-forest
+    :param output: format of features (see DataTransformer.prepare_train)
+    :param n_workers: number of worker processes
+    :return: merged forest (None if no sub-forest can be merged)
+    """
+    # Workers would draw the same random numbers, so each sub-forest gets its own seed (reproducible if the model
+    # has a fixed random_state)
+    rng = np.random.RandomState({**model.get_params(), **params}.get('random_state'))
+    seeds = rng.randint(np.iinfo(np.int32).max, size=len(shards))
+    shard_params = [{**params, 'n_estimators': n, 'random_state': seed} for n, seed in zip(n_trees, seeds)]
+    if n_workers <= 1:
+        _init_worker(path_to_save, transformer, output)
+        forests = list(map(_fit_shard, shards, [model] * len(shards), shard_params))
+    else:
+        # The transformer is sent to every worker once; tasks are only numbers of segments and parameters
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker,
+                                 initargs=(path_to_save, transformer, output)) as pool:
+            forests = list(pool.map(_fit_shard, shards, [model] * len(shards), shard_params))
+    return merge_forests(forests)
@@ -0,0 +1,109 @@
+import typing
+import numpy as np
+import pandas as pd
+
+
+class QuantileSketch:
+    def __init__(self, size=200):
+        """
+        QuantileSketch approximates quantiles of a stream of numbers in constant memory.
+        Values are summarized by at most size weighted centroids; sketches of different streams can be merged
+
+        :param size: maximum number of centroids
+        """
+        self.size = size
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+
+    def __add(self, means: np.ndarray, weights: np.ndarray):
+        means = np.concatenate((self.means, means))
+        weights = np.concatenate((self.weights, weights))
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+
+        if means.shape[0] > self.size:
+            # Merge neighbouring centroids into size buckets of equal weight
+            cum = np.cumsum(weights)
+            buckets = np.floor(self.size * (cum - weights / 2) / cum[-1]).astype(np.int64)
+            new_weights = np.bincount(buckets, weights=weights)
+            new_means = np.bincount(buckets, weights=weights * means)
+            nonempty = new_weights > 0
+            means = new_means[nonempty] / new_weights[nonempty]
+            weights = new_weights[nonempty]
+
+        self.means, self.weights = means, weights
+
+    def update(self, values: np.ndarray):
+        """
+        Add values (missing values are ignored)
+
+        :param values: values
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if values.shape[0]:
+            self.__add(values, np.ones(values.shape[0]))
+
+    def merge(self, other: 'QuantileSketch'):
+        self.__add(other.means, other.weights)
+
+    def count(self) -> float:
+        return self.weights.sum()
+
+    def quantile(self, q: typing.Union[float, np.ndarray]) -> typing.Union[float, np.ndarray]:
+        """
+        Estimate quantile. The estimate is exact while the number of values does not exceed size
+
+        :param q: quantile level(s) in [0, 1]
+        :return: quantile(s)
+        """
+        if not self.weights.shape[0]:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        positions = np.cumsum(self.weights) - self.weights / 2
+        return np.interp(np.asarray(q) * self.weights.sum(), positions, self.means)
+
+
+class HeavyHitters:
+    def __init__(self, size=100):
+        """
+        HeavyHitters counts the most frequent values of a stream in constant memory (Misra-Gries summary).
+        Any value whose frequency exceeds 1 / (size + 1) of the stream is kept; counts are underestimated by at most
+        that fraction. Summaries of different streams can be merged
+
+        :param size: maximum number of counters
+        """
+        self.size = size
+        self.counts = {}
+
+    def __add(self, counts: typing.Mapping[typing.Any, float]):
+        for value, count in counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        if len(self.counts) > self.size:
+            threshold = sorted(self.counts.values(), reverse=True)[self.size]
+            self.counts = {value: count - threshold for value, count in self.counts.items() if count > threshold}
+
+    def update(self, values: typing.Union[np.ndarray, pd.Series]):
+        """
+        Add values (missing values are ignored)
+
+        :param values: values
+        """
+        counts = pd.Series(values).value_counts()
+        # Unused categories of pandas categorical values have zero counts
+        self.__add(counts[counts > 0].to_dict())
+
+    def merge(self, other: 'HeavyHitters'):
+        self.__add(other.counts)
+
+    def top(self, n: int = None) -> list[tuple[typing.Any, float]]:
+        """
+        Get the most frequent values
+
+        :param n: number of values (None for all counted values)
+        :return: list of (value, count) in decreasing order of counts
+        """
+        return sorted(self.counts.items(), key=lambda item: -item[1])[:n]
+
+    def mode(self) -> typing.Any:
+        top = self.top(1)
+        return top[0][0] if top else np.nan
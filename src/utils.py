@@ -1,5 +1,7 @@
+import os
 import typing
 import pickle
+import contextlib
 import pandas as pd
 
 
@@ -29,6 +31,24 @@ def xy_to_data(x: pd.DataFrame, y: pd.DataFrame) -> pd.DataFrame:
     return pd.concat((x, y), axis=1)
 
 
+@contextlib.contextmanager
+def replace_atomically(fn: str) -> typing.Iterator[str]:
+    """
+    Provide a temporary filename to write to, then move the written file to the destination.
+    The destination file is never left partially written
+
+    :param fn: destination filename
+    :return: temporary filename
+    """
+    tmp_fn = f'{fn}.{os.getpid()}.tmp'
+    try:
+        yield tmp_fn
+        os.replace(tmp_fn, fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+
 def save(fn: str, data: typing.Any):
     """
     Save data to file
@@ -36,8 +56,9 @@ def save(fn: str, data: typing.Any):
     :param fn: destination filename
     :param data: data to save
     """
-    with open(fn, 'wb') as f:
-        pickle.dump(data, f)
+    with replace_atomically(fn) as tmp_fn:
+        with open(tmp_fn, 'wb') as f:
+            pickle.dump(data, f)
 
 
 def read(fn: str) -> typing.Any: